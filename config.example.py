@@ -48,13 +48,71 @@ MAIN_ANNOUNCE_URL = ''
 
 BACKUP_TORRENT_FOLDER = 'torrents'
 
+# Seconds a logged in user's id/username/level/status is cached for between page views.
+# Level and status changes made on this process are applied immediately, and POSTs (uploads,
+# edits, comments...) always check them, so a ban made elsewhere can't be outrun.
+USER_CACHE_TTL = 15
+# Seconds a verified API token is remembered for, before being looked up again. Revoked
+# tokens stop working within USER_CACHE_TTL regardless, through the user snapshot.
+API_TOKEN_CACHE_TTL = 300
+# Seconds a rendered public RSS feed is served from memory before being queried again
+RSS_CACHE_TTL = 60
+# Keep every info_hash in memory for /api/v2/lookup, instead of querying the database.
+# Takes a few seconds to load in the background when a worker starts, and ~30MB per million.
+USE_INFO_HASH_INDEX = False
+# Seconds between loading new torrents into the in-memory info_hash index
+INFO_HASH_INDEX_REFRESH = 60
+
 #
 # Search Options
 #
 # Max ES search results, do not set over 10000
 RESULTS_PER_PAGE = 75
+# Items in an RSS feed, defaults to RESULTS_PER_PAGE
+RSS_RESULTS_PER_PAGE = 75
+
+# Send result pages and RSS feeds in chunks as they are rendered, instead of building
+# the whole page in memory first. Works with the gevent loop in uwsgi.ini.
+STREAM_TEMPLATES = False
+# Template pieces joined into each chunk when streaming
+STREAM_BUFFER_SIZE = 20
 
 USE_ELASTIC_SEARCH = False
 ENABLE_ELASTIC_SEARCH_HIGHLIGHT = False
 ES_MAX_SEARCH_RESULT = 1000
-ES_INDEX_NAME = SITE_FLAVOR  # we create indicies named nyaa or sukebei
\ No newline at end of file
+# Let concurrent identical searches (per process) share a single ES query
+COALESCE_SEARCHES = True
+
+# Seconds before an ES search gives up
+ES_SEARCH_TIMEOUT = 5
+# Searches slower than this (seconds) count as failures. When half of the recent searches
+# fail, ES isn't queried for ES_BREAKER_RESET_TIME seconds and recent results are served from
+# memory (for up to ES_FALLBACK_CACHE_TTL seconds), or the database is searched instead.
+ES_SLOW_SEARCH_TIME = 2
+ES_BREAKER_RESET_TIME = 30
+ES_FALLBACK_CACHE_TTL = 600
+ES_FALLBACK_CACHE_SIZE = 1000
+# Database search is slower, so only this many pages are served while falling back to it
+ES_FALLBACK_MAX_PAGES = 5
+ES_INDEX_NAME = SITE_FLAVOR  # we create indicies named nyaa or sukebei
+# Index with just the seed/leech/download counts (created by create_es.sh as nyaa_stats or
+# sukebei_stats), kept up to date by sync_es.py when its es_stats_index_names is set. Result
+# pages show the counts from there, while the torrent documents, which sorting uses, only get
+# them in batches. Saves reindexing the whole torrent on every tracker update.
+ES_STATS_INDEX = None
+# Index for hidden and deleted torrents (created by create_es.sh as nyaa_hidden or
+# sukebei_hidden). When set, ES_INDEX_NAME only has public torrents, so searches by anyone
+# but moderators and uploaders looking at their own torrents skip the rest without filtering.
+# The ES sync scripts need to be told about it too, see the README.
+ES_HIDDEN_INDEX_NAME = None
+# Queue changed torrents in the es_outbox table, for sync_es_outbox.py to index.
+# An alternative to sync_es.py for databases without binlog access (SQLite, managed MySQL).
+USE_ES_OUTBOX = False
+# Outbox rows sync_es_outbox.py handles per bulk request, and seconds to wait when it's empty
+ES_OUTBOX_BATCH_SIZE = 1000
+ES_OUTBOX_POLL_INTERVAL = 5
+# Where sync_es_outbox.py writes the changes es refuses for good, one JSON object per line
+ES_OUTBOX_DEAD_LETTER = '/tmp/sync_es_outbox_dead_letter.jsonl'
+# Set if the index was created with the index.sort settings in es_mapping.yml (ES 6.0+),
+# lets newest-first searches that don't need a total (RSS, API) terminate early.
+ES_INDEX_SORTED = False
\ No newline at end of file
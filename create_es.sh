@@ -1,5 +1,24 @@
 #!/usr/bin/env bash
 
-# create indicies named "nyaa" and "sukebei", these are hardcoded
-curl -v -XPUT 'localhost:9200/nyaa?pretty' -H"Content-Type: application/yaml" --data-binary @es_mapping.yml
-curl -v -XPUT 'localhost:9200/sukebei?pretty' -H"Content-Type: application/yaml" --data-binary @es_mapping.yml
+# create versioned indicies "nyaa_v<N>" and "sukebei_v<N>" (N defaults to 1).
+# the app and sync scripts use the aliases "nyaa" and "sukebei", these are hardcoded.
+# the first version gets the aliases right away; for a later one, import into it
+# and move the aliases over with swap_es_alias.py, see the README.
+# the same goes for "nyaa_hidden_v<N>" and "sukebei_hidden_v<N>", behind the aliases
+# "nyaa_hidden" and "sukebei_hidden", see ES_HIDDEN_INDEX_NAME in config.example.py.
+VERSION="${1:-1}"
+
+for SITE in nyaa sukebei nyaa_hidden sukebei_hidden; do
+    curl -v -XPUT "localhost:9200/${SITE}_v${VERSION}?pretty" -H"Content-Type: application/yaml" --data-binary @es_mapping.yml
+    if [ "$VERSION" = "1" ]; then
+        curl -v -XPOST 'localhost:9200/_aliases?pretty' -H"Content-Type: application/json" \
+            -d "{\"actions\": [{\"add\": {\"index\": \"${SITE}_v${VERSION}\", \"alias\": \"${SITE}\"}}]}"
+    fi
+done
+
+# the hot stats indices, see ES_STATS_INDEX in config.example.py
+if [ "$VERSION" = "1" ]; then
+    for SITE in nyaa sukebei; do
+        curl -v -XPUT "localhost:9200/${SITE}_stats?pretty" -H"Content-Type: application/yaml" --data-binary @es_mapping_stats.yml
+    done
+fi
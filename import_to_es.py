@@ -4,23 +4,56 @@ Bulk load torents from mysql into elasticsearch `nyaav2` index,
 which is assumed to already exist.
 This is a one-shot deal, so you'd either need to complement it
 with a cron job or some binlog-reading thing (TODO)
+
+Use --index to import into a new versioned index (like nyaa_v2) without
+touching the live one, before moving the alias over with swap_es_alias.py.
+With ES_HIDDEN_INDEX_NAME set (or --hidden-index), hidden and deleted
+torrents go to that index instead, leaving the main one to public torrents.
+
+With --workers N, the id space is split into N ranges, each imported by
+its own process using parallel_bulk, to keep the database and es busy.
+
+Progress is saved to a checkpoint file as es acknowledges the documents, so
+an interrupted import can be continued with --resume. The binlog position
+from when the import started is kept there too, and written out with
+--pos-file once it's done, ready for sync_es.py to pick up from.
 """
-from nyaa import app
-from nyaa.models import Torrent
+from nyaa import app, db
+from nyaa import es_docs
+from nyaa.models import Torrent, Statistic
+from sqlalchemy import func
 from elasticsearch import Elasticsearch
 from elasticsearch.client import IndicesClient
 from elasticsearch import helpers
 import progressbar
+import argparse
+import multiprocessing
+import json
+import time
 import sys
+import os
 
-bar = progressbar.ProgressBar(
-        max_value=Torrent.query.count(),
-        widgets=[
-            progressbar.SimpleProgress(),
-            ' [', progressbar.Timer(), '] ',
-            progressbar.Bar(),
-            ' (', progressbar.ETA(), ') ',
-            ])
+parser = argparse.ArgumentParser(description='Bulk load torrents into elasticsearch.')
+parser.add_argument('--index', default=app.config['ES_INDEX_NAME'],
+                    help='index to import into, defaults to ES_INDEX_NAME')
+parser.add_argument('--hidden-index', default=app.config.get('ES_HIDDEN_INDEX_NAME'),
+                    help='index to import hidden and deleted torrents into, '
+                         'defaults to ES_HIDDEN_INDEX_NAME')
+parser.add_argument('--workers', type=int, default=1,
+                    help='processes to import with, each taking a range of torrent ids')
+parser.add_argument('--threads', type=int, default=4,
+                    help='bulk requests in flight per worker process (with --workers)')
+parser.add_argument('--pos-file',
+                    help='where to write the binlog position from when the import started, '
+                         'for sync_es.py to continue from (its save_loc)')
+parser.add_argument('--checkpoint',
+                    help='progress file to resume from if the import is interrupted, '
+                         'defaults to import_to_es_<index>.checkpoint.json')
+parser.add_argument('--resume', action='store_true',
+                    help='continue the import saved in the checkpoint file')
+args = parser.parse_args()
+if not args.checkpoint:
+    args.checkpoint = f"import_to_es_{args.index}.checkpoint.json"
 
 es = Elasticsearch(timeout=30)
 ic = IndicesClient(es)
@@ -32,69 +65,199 @@ ic = IndicesClient(es)
 # we don't want to reindex all the user's torrents just because they
 # changed their name, and we don't really want to FTS search on the user anyway.
 # Maybe it's more convenient to derefence though.
-def mk_es(t):
-    return {
-        "_id": t.id,
+#
+# Takes a batch of IMPORT_COLUMNS rows, the documents come from nyaa.es_docs.
+def mk_es(rows):
+    return [{
+        "_id": doc['id'],
         "_type": "torrent",
-        "_index": app.config['ES_INDEX_NAME'],
-        "_source": {
-            # we're also indexing the id as a number so you can
-            # order by it. seems like this is just equivalent to
-            # order by created_time, but oh well
-            "id": t.id,
-            "display_name": t.display_name,
-            "created_time": t.created_time,
-            # not analyzed but included so we can render magnet links
-            # without querying sql again.
-            "info_hash": t.info_hash.hex(),
-            "filesize": t.filesize,
-            "uploader_id": t.uploader_id,
-            "main_category_id": t.main_category_id,
-            "sub_category_id": t.sub_category_id,
-            # XXX all the bitflags are numbers
-            "anonymous": bool(t.anonymous),
-            "trusted": bool(t.trusted),
-            "remake": bool(t.remake),
-            "complete": bool(t.complete),
-            # TODO instead of indexing and filtering later
-            # could delete from es entirely. Probably won't matter
-            # for at least a few months.
-            "hidden": bool(t.hidden),
-            "deleted": bool(t.deleted),
-            "has_torrent": t.has_torrent,
-            # Stats
-            "download_count": t.stats.download_count,
-            "leech_count": t.stats.leech_count,
-            "seed_count": t.stats.seed_count,
-        }
-    }
+        "_index": args.index if not args.hidden_index or es_docs.is_public(doc)
+                  else args.hidden_index,
+        "_source": doc,
+    } for doc in es_docs.torrent_docs(rows)]
+
+# just the columns the documents need, not whole Torrents with their eager joins
+IMPORT_COLUMNS = tuple(getattr(Torrent, field) for field in es_docs.TORRENT_FIELDS) + \
+    tuple(getattr(Statistic, field) for field in es_docs.STATS_FIELDS)
+
+# stream the torrents in id order, a batch at a time. Each batch starts after
+# the last id of the previous one, so it's a range scan on the primary key
+# instead of an OFFSET that has to skip over everything imported so far.
+#
+# Covers ids after last_id, up to and including end_id (None for no end).
+def range_filter(query, last_id, end_id):
+    query = query.filter(Torrent.id > last_id)
+    if end_id is not None:
+        query = query.filter(Torrent.id <= end_id)
+    return query
 
-# page through an sqlalchemy query, like the per_fetch but
-# doesn't break the eager joins its doing against the stats table.
-# annoying that this isn't built in somehow.
-def page_query(query, limit=sys.maxsize, batch_size=10000):
-    start = 0
+def page_query(last_id=0, end_id=None, batch_size=10000, doc_batch_size=1000):
     while True:
-        # XXX very inelegant way to do this, i'm confus
-        stop = min(limit, start + batch_size)
-        if stop == start:
+        query = db.session.query(*IMPORT_COLUMNS) \
+            .outerjoin(Statistic, Statistic.torrent_id == Torrent.id)
+        query = range_filter(query, last_id, end_id) \
+            .order_by(Torrent.id) \
+            .limit(batch_size) \
+            .execution_options(stream_results=True)
+        # yields lists of rows, the documents are built a batch at a time
+        count = 0
+        rows = []
+        for row in query:
+            rows.append(row)
+            count += 1
+            if len(rows) == doc_batch_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+        if not count:
             break
-        things = query.slice(start, stop)
-        if not things:
+        last_id = row.id
+        if count < batch_size:
             break
-        had_things = False
-        for thing in things:
-            had_things = True
-            yield(thing)
-        if not had_things or stop == limit:
-            break
-        bar.update(start)
-        start = min(limit, start + batch_size)
+
+# where the binlog is right now, in the format sync_es.py saves. anything
+# changed after this is picked up by sync_es starting from here.
+def binlog_position():
+    if not app.config['USE_MYSQL']:
+        return None
+    status = db.session.execute('SHOW MASTER STATUS').first()
+    if status is None:
+        # binlogging is off
+        return None
+    return {"log_file": status[0], "log_pos": status[1]}
+
+def write_json(path, data):
+    # write and rename, so a crash never leaves half a file behind
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+# runs in its own process, with its own database connections. last_ids[i] is
+# the highest id es has acknowledged so far; everything in the range up to
+# it is imported, since the results come back in id order.
+def import_range(i, end_id, last_ids, done):
+    worker_es = Elasticsearch(timeout=30)
+    actions = (action for rows in page_query(last_ids[i], end_id) for action in mk_es(rows))
+    if args.workers > 1:
+        results = helpers.parallel_bulk(worker_es, actions, thread_count=args.threads,
+                                        chunk_size=10000)
+    else:
+        results = helpers.streaming_bulk(worker_es, actions, chunk_size=10000)
+
+    # these raise on errors
+    last_id = last_ids[i]
+    acknowledged = 0
+    for _, result in results:
+        _, result = result.popitem()
+        last_id = int(result['_id'])
+        acknowledged += 1
+        if acknowledged == 1000:
+            with done.get_lock():
+                last_ids[i] = last_id
+                done.value += acknowledged
+            acknowledged = 0
+
+    with done.get_lock():
+        # the whole range is done, even if its last ids were deleted
+        last_ids[i] = last_id if end_id is None else end_id
+        done.value += acknowledged
+
+def run_import(checkpoint):
+    ranges = checkpoint['ranges']
+
+    bar = progressbar.ProgressBar(
+            max_value=sum(range_filter(db.session.query(func.count(Torrent.id)), *r).scalar()
+                          for r in ranges),
+            widgets=[
+                progressbar.SimpleProgress(),
+                ' [', progressbar.Timer(), '] ',
+                progressbar.Bar(),
+                ' (', progressbar.ETA(), ') ',
+                ])
+
+    # don't hand open database connections down to the workers
+    db.session.close()
+    db.engine.dispose()
+
+    last_ids = multiprocessing.Array('q', [last_id for last_id, _ in ranges])
+    done = multiprocessing.Value('q', 0)
+    processes = [multiprocessing.Process(target=import_range, args=(i, end_id, last_ids, done))
+                 for i, (_, end_id) in enumerate(ranges)]
+    for process in processes:
+        process.start()
+
+    def save_progress():
+        with done.get_lock():
+            for r, last_id in zip(ranges, last_ids):
+                r[0] = last_id
+            imported = done.value
+        write_json(args.checkpoint, checkpoint)
+        # new uploads can push us past the count we started with
+        bar.update(min(imported, bar.max_value))
+
+    while any(process.is_alive() for process in processes):
+        save_progress()
+        time.sleep(1)
+    save_progress()
+
+    failed = [process for process in processes if process.exitcode != 0]
+    if failed:
+        print(f"{len(failed)} of {len(processes)} workers failed, "
+              f"continue with --resume", file=sys.stderr)
+        sys.exit(1)
+
+def new_checkpoint():
+    # record this before reading anything, so sync_es covers every change since
+    pos = binlog_position()
+
+    min_id, max_id = db.session.query(func.min(Torrent.id), func.max(Torrent.id)).one()
+    if min_id is None:
+        min_id = max_id = 1
+    # split (min_id - 1, max_id] into even id ranges, the last one open-ended
+    # so it picks up torrents uploaded during the import
+    step = (max_id - min_id + 1) / args.workers
+    bounds = [min_id - 1 + int(step * i) for i in range(args.workers)] + [None]
+    return {
+        "index": args.index,
+        "hidden_index": args.hidden_index,
+        "pos": pos,
+        # [last imported id, end id] of each worker's range
+        "ranges": [[bounds[i], bounds[i + 1]] for i in range(args.workers)],
+    }
+
+if args.resume:
+    with open(args.checkpoint) as f:
+        checkpoint = json.load(f)
+    if checkpoint['index'] != args.index:
+        print(f"{args.checkpoint} is an import into {checkpoint['index']}, not {args.index}",
+              file=sys.stderr)
+        sys.exit(1)
+    # the import so far went wherever these pointed
+    args.hidden_index = checkpoint.get('hidden_index')
+    # the ranges are fixed when the import starts
+    args.workers = len(checkpoint['ranges'])
+elif os.path.exists(args.checkpoint):
+    print(f"{args.checkpoint} exists, continue that import with --resume or delete it",
+          file=sys.stderr)
+    sys.exit(1)
+else:
+    checkpoint = new_checkpoint()
+    write_json(args.checkpoint, checkpoint)
 
 # turn off refreshes while bulk loading
-ic.put_settings(body={'index': {'refresh_interval': '-1'}}, index=app.config['ES_INDEX_NAME'])
+indices = ','.join(index for index in (args.index, args.hidden_index) if index)
+ic.put_settings(body={'index': {'refresh_interval': '-1'}}, index=indices)
 
-helpers.bulk(es, (mk_es(t) for t in page_query(Torrent.query)), chunk_size=10000)
+try:
+    run_import(checkpoint)
+finally:
+    # restore to near-enough real time
+    ic.put_settings(body={'index': {'refresh_interval': '30s'}}, index=indices)
 
-# restore to near-enough real time
-ic.put_settings(body={'index': {'refresh_interval': '30s'}}, index=app.config['ES_INDEX_NAME'])
+if args.pos_file:
+    if checkpoint['pos'] is None:
+        print("no binlog position to write, is binlogging on?", file=sys.stderr)
+    else:
+        write_json(args.pos_file, checkpoint['pos'])
+os.remove(args.checkpoint)
@@ -0,0 +1,33 @@
+"""Add api_token column to users table.
+
+Revision ID: 5a2a6eb6e3f9
+Revises: 3001f79b7722
+Create Date: 2026-10-19 09:12:40.118344
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '5a2a6eb6e3f9'
+down_revision = '3001f79b7722'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite can't add a constraint to an existing table, a batch recreates the table there
+    with op.batch_alter_table('users') as batch_op:
+        # Fixed length BINARY on MySQL, like models.BinaryType
+        batch_op.add_column(sa.Column('api_token', sa.Binary(length=32)
+                                      .with_variant(mysql.BINARY(length=32), 'mysql'),
+                                      nullable=True))
+        batch_op.create_unique_constraint('uq_users_api_token', ['api_token'])
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_constraint('uq_users_api_token', type_='unique')
+        batch_op.drop_column('api_token')
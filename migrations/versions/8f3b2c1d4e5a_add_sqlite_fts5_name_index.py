@@ -0,0 +1,58 @@
+"""Add an FTS5 index on torrent names for SQLite databases.
+
+Revision ID: 8f3b2c1d4e5a
+Revises: 5a2a6eb6e3f9
+Create Date: 2026-10-19 11:02:13.564120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f3b2c1d4e5a'
+down_revision = '5a2a6eb6e3f9'
+branch_labels = None
+depends_on = None
+
+TABLE_PREFIXES = ('nyaa_', 'sukebei_')
+
+CREATE_STATEMENTS = [
+    "CREATE VIRTUAL TABLE {fts} USING fts5("
+    "display_name, content='{torrents}', content_rowid='id')",
+    "CREATE TRIGGER {fts}_ai AFTER INSERT ON {torrents} BEGIN "
+    "INSERT INTO {fts}(rowid, display_name) VALUES (new.id, new.display_name); END",
+    "CREATE TRIGGER {fts}_ad AFTER DELETE ON {torrents} BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, display_name) "
+    "VALUES ('delete', old.id, old.display_name); END",
+    "CREATE TRIGGER {fts}_au AFTER UPDATE OF display_name ON {torrents} BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, display_name) "
+    "VALUES ('delete', old.id, old.display_name); "
+    "INSERT INTO {fts}(rowid, display_name) VALUES (new.id, new.display_name); END",
+    # Index the torrents that already exist
+    "INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+]
+
+
+def _existing_torrent_tables():
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        # MySQL uses its FULLTEXT index instead
+        return []
+    table_names = sa.inspect(bind).get_table_names()
+    return [prefix for prefix in TABLE_PREFIXES if prefix + 'torrents' in table_names]
+
+
+def upgrade():
+    for prefix in _existing_torrent_tables():
+        params = {'fts': prefix + 'torrents_fts', 'torrents': prefix + 'torrents'}
+        for statement in CREATE_STATEMENTS:
+            op.execute(statement.format(**params))
+
+
+def downgrade():
+    for prefix in _existing_torrent_tables():
+        fts = prefix + 'torrents_fts'
+        for trigger in ('ai', 'ad', 'au'):
+            op.execute('DROP TRIGGER IF EXISTS {}_{}'.format(fts, trigger))
+        op.execute('DROP TABLE IF EXISTS {}'.format(fts))
@@ -0,0 +1,32 @@
+"""Add es_outbox tables.
+
+Revision ID: b7e4a0c2f913
+Revises: 8f3b2c1d4e5a
+Create Date: 2026-10-19 13:40:52.301877
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4a0c2f913'
+down_revision = '8f3b2c1d4e5a'
+branch_labels = None
+depends_on = None
+
+TABLE_PREFIXES = ('nyaa_', 'sukebei_')
+
+
+def upgrade():
+    for prefix in TABLE_PREFIXES:
+        op.create_table(prefix + 'es_outbox',
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('torrent_id', sa.Integer(), nullable=False),
+                        sa.Column('created_time', sa.DateTime(), nullable=True),
+                        sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    for prefix in TABLE_PREFIXES:
+        op.drop_table(prefix + 'es_outbox')
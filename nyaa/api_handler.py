@@ -5,25 +5,72 @@ from nyaa import app, db
 from nyaa import models, forms
 from nyaa import bencode, backend, utils
 from nyaa import torrents
+from nyaa.search import search_elastic_or_none, search_db
+from nyaa.search import encode_search_cursor, decode_search_cursor, decode_search_after
+from nyaa.search import es_hits_total
+from nyaa.hash_index import info_hash_index
 
 # For _create_upload_category_choices
 from nyaa import routes
 
+import re
+import base64
+import binascii
 import functools
 import json
 import os.path
 
 api_blueprint = flask.Blueprint('api', __name__)
 
+# Maps verified API token hashes to user ids, so repeated calls skip the users table.
+# Hits are checked against the user's snapshot, which other processes refresh often enough
+# to notice a revoked token (see USER_CACHE_TTL).
+_api_token_cache = utils.TimedCache(ttl=app.config.get('API_TOKEN_CACHE_TTL', 300))
+
 # #################################### API HELPERS ####################################
 
 
+def _user_from_api_token(token):
+    ''' Returns the active user (snapshot) owning the given API token, or None '''
+    token_hash = models.User.hash_api_token(token)
+
+    user_id = _api_token_cache.get(token_hash)
+    if user_id is None:
+        user = models.User.by_api_token_hash(token_hash)
+        if not user:
+            return None
+        user_id = _api_token_cache.set(token_hash, user.id)
+
+    # Like in routes.before_request, requests that can change something check the user afresh
+    fresh = flask.request.method not in ('GET', 'HEAD', 'OPTIONS')
+    user = models.User.snapshot_by_id(user_id, fresh=fresh)
+    if not user or user.api_token != token_hash:
+        # Replaced in another process since we cached it
+        _api_token_cache.pop(token_hash)
+        return None
+    if user.status == models.UserStatusType.ACTIVE:
+        return user
+
+
+def invalidate_api_token(token_hash):
+    ''' Forget a cached token, call when the user's token is replaced '''
+    _api_token_cache.pop(token_hash)
+
+
 def basic_auth_user(f):
-    ''' A decorator that will try to validate the user into g.user from basic auth.
+    ''' A decorator that will try to validate the user into g.user from an
+        "Authorization: Bearer <api token>" header or basic auth.
         Note: this does not set user to None on failure, so users can also authorize
         themselves with the cookie (handled in routes.before_request). '''
     @functools.wraps(f)
     def decorator(*args, **kwargs):
+        auth_header = flask.request.headers.get('Authorization', '')
+        if auth_header.startswith('Bearer '):
+            user = _user_from_api_token(auth_header[len('Bearer '):].strip())
+            if user:
+                flask.g.user = user
+            return f(*args, **kwargs)
+
         auth = flask.request.authorization
         if auth:
             user = models.User.by_username_or_email(auth.get('username'))
@@ -115,6 +162,240 @@ def v2_api_upload():
         return flask.jsonify({'errors': mapped_errors}), 400
 
 
+# Every field a search result row can have, in output order
+SEARCH_API_FIELDS = ('id', 'name', 'hash', 'size', 'category', 'created', 'stats', 'flags')
+SEARCH_API_FLAGS = ('anonymous', 'hidden', 'trusted', 'remake', 'complete', 'deleted')
+
+
+def _json_response(data, status=200):
+    ''' Like flask.jsonify, but always compact '''
+    return flask.Response(json.dumps(data, separators=(',', ':')), status=status,
+                          mimetype='application/json')
+
+
+# How to build each row field from an ES hit, and the _source fields that needs
+SEARCH_API_ES_FIELDS = {
+    'id': ([], lambda hit: int(hit.meta.id)),
+    'name': (['display_name'], lambda hit: hit.display_name),
+    'hash': (['info_hash'], lambda hit: hit.info_hash),
+    'size': (['filesize'], lambda hit: hit.filesize),
+    'category': (['main_category_id', 'sub_category_id'],
+                 lambda hit: '{}_{}'.format(hit.main_category_id, hit.sub_category_id)),
+    'created': (['created_time'], lambda hit: routes.get_utc_timestamp(hit.created_time)),
+    'stats': (['seed_count', 'leech_count', 'download_count'],
+              lambda hit: [getattr(hit, 'seed_count', 0), getattr(hit, 'leech_count', 0),
+                           getattr(hit, 'download_count', 0)]),
+    'flags': (list(SEARCH_API_FLAGS),
+              lambda hit: [flag for flag in SEARCH_API_FLAGS if getattr(hit, flag, False)])
+}
+
+
+def _es_hit_to_row(hit, fields):
+    return {field: SEARCH_API_ES_FIELDS[field][1](hit) for field in fields}
+
+
+def _torrent_to_row(torrent):
+    return {
+        'id': torrent.id,
+        'name': torrent.display_name,
+        'hash': torrent.info_hash_as_hex,
+        'size': torrent.filesize,
+        'category': torrent.sub_category.id_as_string,
+        'created': int(torrent.created_utc_timestamp),
+        'stats': [torrent.stats.seed_count, torrent.stats.leech_count,
+                  torrent.stats.download_count],
+        'flags': [flag for flag in SEARCH_API_FLAGS if getattr(torrent, flag)]
+    }
+
+
+@api_blueprint.route('/v2/search', methods=['GET'])
+@basic_auth_user
+def v2_api_search():
+    ''' Searches torrents with the same parameters as the home page (q, c, f, u, s, o).
+        Results are paged with an opaque cursor (the returned "next" value), and
+        the "fields" parameter limits rows to the given comma-separated fields.
+        Stats are [seeders, leechers, downloads]. "total" may be null for ES searches.
+        ES results use search_after cursors, so they can be paged through without a limit. '''
+    req_args = flask.request.args
+
+    search_term = routes.chain_get(req_args, 'q', 'term')
+    user_name = routes.chain_get(req_args, 'u', 'user')
+
+    fields = SEARCH_API_FIELDS
+    if req_args.get('fields'):
+        fields = [field for field in req_args['fields'].split(',') if field in SEARCH_API_FIELDS]
+        if not fields:
+            return _json_response({'errors': ['No valid fields requested']}, 400)
+
+    use_elastic = app.config.get('USE_ELASTIC_SEARCH')
+    use_elastic_cursor = use_elastic and search_term
+
+    # ES cursors are the sort values of the last hit, database cursors a page number
+    page_number = 1
+    search_after = None
+    if req_args.get('cursor'):
+        if use_elastic_cursor:
+            search_after = decode_search_after(req_args['cursor'], req_args.get('s') or 'id')
+            if search_after is None:
+                return _json_response({'errors': ['Invalid cursor']}, 400)
+        else:
+            position = decode_search_cursor(req_args['cursor'])
+            if not isinstance(position, dict) or not isinstance(position.get('p'), int) \
+                    or position['p'] < 1:
+                return _json_response({'errors': ['Invalid cursor']}, 400)
+            page_number = position['p']
+
+    results_per_page = app.config.get('RESULTS_PER_PAGE', routes.DEFAULT_PER_PAGE)
+
+    user_id = None
+    if user_name:
+        user = models.User.by_username(user_name)
+        if not user:
+            return _json_response({'errors': ['No such user']}, 404)
+        user_id = user.id
+
+    query_args = {
+        'user': user_id,
+        'sort': req_args.get('s') or 'id',
+        'order': req_args.get('o') or 'desc',
+        'category': routes.chain_get(req_args, 'c', 'cats') or '0_0',
+        'quality_filter': routes.chain_get(req_args, 'f', 'filter') or '0',
+        'page': page_number,
+        'rss': False,
+        'per_page': results_per_page
+    }
+
+    if flask.g.user:
+        query_args['logged_in_user'] = flask.g.user
+        if flask.g.user.is_moderator:  # God mode
+            query_args['admin'] = True
+
+    next_cursor = None
+    if use_elastic_cursor:
+        query_args['term'] = search_term
+        # None on the first page, which is a regular page 1
+        query_args['search_after'] = search_after
+        query_args['exact_total'] = False
+        # Have ES return only what the requested fields are built from
+        query_args['source_fields'] = sorted(set(
+            source_field for field in fields
+            for source_field in SEARCH_API_ES_FIELDS[field][0])) or False
+
+        query_results = search_elastic_or_none(**query_args)
+        if query_results is None:
+            # Our cursors don't carry over to database search, so don't fall back to it
+            return _json_response({'errors': ['Search is temporarily unavailable']}, 503)
+
+        # Not counted when ES can stop early, see ES_INDEX_SORTED
+        total = es_hits_total(query_results)
+        rows = [_es_hit_to_row(hit, fields) for hit in query_results]
+        if len(rows) == results_per_page:
+            next_cursor = encode_search_cursor(list(query_results[-1].meta.sort))
+    else:
+        query_args['term'] = '' if use_elastic else (search_term or '')
+
+        query = search_db(**query_args)
+
+        total = query.total
+        rows = [_torrent_to_row(torrent) for torrent in query.items]
+        if query.has_next:
+            next_cursor = encode_search_cursor({'p': query_args['page'] + 1})
+
+        if fields is not SEARCH_API_FIELDS:
+            rows = [{field: row[field] for field in fields} for row in rows]
+
+    return _json_response({'total': total, 'next': next_cursor, 'results': rows})
+
+
+LOOKUP_API_MAX_HASHES = 1000
+
+
+def _parse_info_hash(hash_str):
+    ''' Parses a hex (40 chars) or base32 (32 chars) info_hash into bytes, or None '''
+    hash_str = hash_str.strip()
+    try:
+        if re.match(r'^[0-9a-fA-F]{40}$', hash_str):
+            return bytes.fromhex(hash_str)
+        if re.match(r'^[A-Za-z2-7]{32}$', hash_str):
+            return base64.b32decode(hash_str.upper())
+    except (ValueError, binascii.Error):
+        pass
+    return None
+
+
+def _torrent_visibility(flags):
+    if flags & models.TorrentFlags.DELETED:
+        return 'deleted'
+    if flags & models.TorrentFlags.HIDDEN:
+        return 'hidden'
+    return 'public'
+
+
+@api_blueprint.route('/v2/lookup', methods=['POST'])
+@basic_auth_user
+def v2_api_lookup():
+    ''' Looks up many info_hashes at once. Takes a JSON body of {"hashes": [...]}
+        or a "hashes" form field of whitespace or comma-separated hashes, in hex or base32.
+        Returns {"results": {hash: {"id": ..., "visibility": ...} or null}}, with null
+        also for torrents the caller can't see (unless they're a moderator, deleted
+        torrents and other users' hidden ones). '''
+    request_json = flask.request.get_json(silent=True)
+    if request_json is not None:
+        hash_strs = request_json.get('hashes') if isinstance(request_json, dict) else None
+        if not isinstance(hash_strs, list) or not all(isinstance(h, str) for h in hash_strs):
+            return _json_response({'errors': ['hashes must be a list of strings']}, 400)
+    else:
+        hash_strs = re.split(r'[\s,]+', flask.request.form.get('hashes', '').strip())
+        hash_strs = [hash_str for hash_str in hash_strs if hash_str]
+
+    if not hash_strs:
+        return _json_response({'errors': ['No hashes given']}, 400)
+    if len(hash_strs) > LOOKUP_API_MAX_HASHES:
+        return _json_response(
+            {'errors': ['Too many hashes (max {})'.format(LOOKUP_API_MAX_HASHES)]}, 400)
+
+    parsed_hashes = {}
+    invalid = []
+    for hash_str in hash_strs:
+        info_hash = _parse_info_hash(hash_str)
+        if info_hash is None:
+            invalid.append(hash_str)
+        else:
+            parsed_hashes[hash_str] = info_hash
+
+    found = info_hash_index.lookup(set(parsed_hashes.values()))
+
+    # The index only maps hashes to ids, flags change so they are always read fresh
+    torrent_rows = {}
+    if found:
+        torrent_rows = {torrent_id: (flags, uploader_id) for torrent_id, flags, uploader_id in
+                        db.session.query(models.Torrent.id, models.Torrent.flags,
+                                         models.Torrent.uploader_id)
+                        .filter(models.Torrent.id.in_(set(found.values())))}
+
+    user = flask.g.user
+    results = {}
+    for hash_str, info_hash in parsed_hashes.items():
+        torrent_id = found.get(info_hash)
+        flags, uploader_id = torrent_rows.get(torrent_id, (None, None))
+        if flags is not None and not (user and user.is_moderator):
+            # Only what view_torrent would show the user: no deleted torrents,
+            # and hidden ones to their uploader only
+            if flags & models.TorrentFlags.DELETED or \
+                    (flags & models.TorrentFlags.HIDDEN and
+                     not (user and user.id == uploader_id)):
+                flags = None
+        if flags is None:
+            results[hash_str] = None
+        else:
+            results[hash_str] = {'id': torrent_id, 'visibility': _torrent_visibility(flags)}
+
+    response = {'results': results}
+    if invalid:
+        response['invalid'] = invalid
+    return _json_response(response)
+
+
 # #################################### TEMPORARY ####################################
 
 from orderedset import OrderedSet  # noqa: E402
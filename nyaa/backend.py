@@ -55,7 +55,7 @@ def handle_torrent_upload(upload_form, uploading_user=None, fromAPI=False):
                              description=description,
                              encoding=torrent_encoding,
                              filesize=torrent_filesize,
-                             user=uploading_user,
+                             uploader_id=uploading_user and uploading_user.id,
                              uploader_ip=ip_address(flask.request.remote_addr).packed)
 
     # Store bencoded info_dict
@@ -0,0 +1,110 @@
+''' Builds the Elasticsearch documents for torrents, shared by import_to_es.py, sync_es.py and
+    sync_es_outbox.py so they always index the same thing. The fields have to match the
+    properties in es_mapping.yml, which nyaa/tests/test_es_docs.py checks.
+
+    Nothing else from nyaa is imported here, so sync_es.py can load this module on its own,
+    without setting up the web app. '''
+import binascii
+
+# Bits of the flags column, the same as models.TorrentFlags (checked by test_es_docs.py)
+ANONYMOUS = 1
+HIDDEN = 2
+TRUSTED = 4
+REMAKE = 8
+COMPLETE = 16
+DELETED = 32
+
+# Torrent columns a document is built from, in the order rows are expected in
+TORRENT_FIELDS = (
+    'id',
+    'display_name',
+    'created_time',
+    'updated_time',
+    'info_hash',
+    'filesize',
+    'uploader_id',
+    'main_category_id',
+    'sub_category_id',
+    'flags',
+    'has_torrent',
+)
+# Statistic columns, which follow the torrent ones in rows with stats
+STATS_FIELDS = (
+    'download_count',
+    'leech_count',
+    'seed_count',
+)
+
+# Document fields decoded from the flags column
+FLAG_FIELDS = (
+    ('anonymous', ANONYMOUS),
+    ('trusted', TRUSTED),
+    ('remake', REMAKE),
+    ('complete', COMPLETE),
+    ('hidden', HIDDEN),
+    ('deleted', DELETED),
+)
+
+# Copied into the document as they are
+PLAIN_FIELDS = ('id', 'display_name', 'created_time', 'updated_time', 'filesize',
+                'uploader_id', 'main_category_id', 'sub_category_id')
+
+INFO_HASH_HEX_LENGTH = 40
+
+
+def _columns(rows, fields):
+    ''' Turns rows (tuples in fields order, or dicts like binlog rows) into a dict of columns '''
+    if rows and isinstance(rows[0], dict):
+        return {field: [row[field] for row in rows] for field in fields}
+    return dict(zip(fields, zip(*rows))) if rows else {field: () for field in fields}
+
+
+def torrent_docs(rows, with_stats=True):
+    ''' Builds the documents for a batch of rows, working a column at a time.
+
+        Rows are tuples of TORRENT_FIELDS (followed by STATS_FIELDS if with_stats),
+        like the ones a column query returns, or dicts with those keys.
+        Without stats, the documents leave the counts out, for partial updates. '''
+    fields = TORRENT_FIELDS + STATS_FIELDS if with_stats else TORRENT_FIELDS
+    columns = _columns(rows, fields)
+
+    doc_columns = {field: columns[field] for field in PLAIN_FIELDS}
+
+    flags = columns['flags']
+    for field, flag in FLAG_FIELDS:
+        doc_columns[field] = [bool(value & flag) for value in flags]
+    doc_columns['has_torrent'] = [bool(value) for value in columns['has_torrent']]
+
+    # Not analyzed, but included so magnet links can be rendered without querying sql again
+    hex_hashes = binascii.hexlify(b''.join(columns['info_hash'])).decode('ascii')
+    doc_columns['info_hash'] = [hex_hashes[i:i + INFO_HASH_HEX_LENGTH]
+                                for i in range(0, len(hex_hashes), INFO_HASH_HEX_LENGTH)]
+
+    if with_stats:
+        # Torrents can be missing their statistics row
+        for field in STATS_FIELDS:
+            doc_columns[field] = [value or 0 for value in columns[field]]
+
+    names = list(doc_columns)
+    return [dict(zip(names, values)) for values in zip(*(doc_columns[name] for name in names))]
+
+
+def torrent_doc(row, with_stats=True):
+    ''' Builds the document for a single row, see torrent_docs '''
+    return torrent_docs([row], with_stats=with_stats)[0]
+
+
+def is_public(doc):
+    ''' Whether the document belongs in the main index when hidden and deleted torrents are kept
+        in their own one (see ES_HIDDEN_INDEX_NAME) '''
+    return not (doc['hidden'] or doc['deleted'])
+
+
+def is_public_flags(flags):
+    ''' Same as is_public, for a torrent's flags column '''
+    return not flags & (HIDDEN | DELETED)
+
+
+def stats_doc(row):
+    ''' The counts of a statistics row (a dict), for a partial update '''
+    return {field: row[field] or 0 for field in STATS_FIELDS}
@@ -94,6 +94,11 @@ class ProfileForm(FlaskForm):
     password_confirm = PasswordField('Repeat New Password')
 
 
+class ApiTokenForm(FlaskForm):
+    ''' No fields, only guards API token regeneration with a CSRF token '''
+    pass
+
+
 # Classes for a SelectField that can be set to disable options (id, name, disabled)
 # TODO: Move to another file for cleaner look
 class DisabledSelectWidget(SelectWidget):
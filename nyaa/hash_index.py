@@ -0,0 +1,242 @@
+import time
+import heapq
+from array import array
+from threading import Lock, Thread
+
+from nyaa import app, db
+from nyaa import models
+
+INFO_HASH_LENGTH = 20
+# Longest wait, in seconds, before retrying a failed full load
+MAX_RETRY_DELAY = 3600
+
+
+class InfoHashIndex(object):
+    ''' An in-memory index of every torrent's info_hash, for answering
+        "does this torrent exist" in bulk without a query per hash.
+
+        The hashes are kept as one sorted bytes object (20 bytes each) with a
+        parallel array of torrent ids, and searched by bisection. New torrents
+        are picked up incrementally by id into a small overlay dict, which is
+        merged into the sorted arrays once it grows past merge_threshold.
+        info_hashes never change, so only new rows need to be loaded.
+
+        Lookups never wait for loading: the first full load runs in the background
+        (see warm), and a refresh already running elsewhere is skipped. Until then,
+        hashes are checked against the database. A failed full load is retried by a
+        later lookup, backing off from refresh_interval up to MAX_RETRY_DELAY.
+        When not enabled, lookups always go to the database. '''
+
+    def __init__(self, enabled=True, refresh_interval=60, merge_threshold=10000,
+                 batch_size=50000):
+        self.enabled = enabled
+        self.refresh_interval = refresh_interval
+        self.merge_threshold = merge_threshold
+        self.batch_size = batch_size
+
+        self._hashes = b''
+        self._ids = array('q')
+        self._recent = {}
+        self._max_id = 0
+        self._loaded = False
+        self._last_refresh = 0
+        # Held while loading, and for any change to _recent
+        self._lock = Lock()
+
+        self._warming = False
+        self._warm_lock = Lock()
+        self._failed_loads = 0
+        self._retry_at = 0
+
+    def __len__(self):
+        # Approximate, the overlay can contain hashes that are also in the arrays
+        return len(self._ids) + len(self._recent)
+
+    def _bisect(self, info_hash):
+        ''' Returns the position of info_hash in the sorted hashes, or where it would be '''
+        hashes = self._hashes
+        lo, hi = 0, len(self._ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = mid * INFO_HASH_LENGTH
+            if hashes[offset:offset + INFO_HASH_LENGTH] < info_hash:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, info_hash):
+        torrent_id = self._recent.get(info_hash)
+        if torrent_id is not None:
+            return torrent_id
+
+        position = self._bisect(info_hash)
+        offset = position * INFO_HASH_LENGTH
+        if self._hashes[offset:offset + INFO_HASH_LENGTH] == info_hash:
+            return self._ids[position]
+        return None
+
+    def _merge_recent(self):
+        ''' Merges the overlay into the sorted arrays. O(n), so only done now and then '''
+        if not self._recent:
+            return
+
+        existing = ((self._hashes[i * INFO_HASH_LENGTH:(i + 1) * INFO_HASH_LENGTH], self._ids[i])
+                    for i in range(len(self._ids)))
+
+        hashes = bytearray()
+        ids = array('q')
+        previous_hash = None
+        for info_hash, torrent_id in heapq.merge(existing, sorted(self._recent.items())):
+            # Hashes found by the database fallback may already be in the arrays
+            if info_hash == previous_hash:
+                continue
+            hashes += info_hash
+            ids.append(torrent_id)
+            previous_hash = info_hash
+
+        self._hashes = bytes(hashes)
+        self._ids = ids
+        self._recent = {}
+
+    def _load_all(self):
+        ''' Builds the sorted arrays from scratch, walking the info_hash index in order '''
+        hashes = bytearray()
+        ids = array('q')
+        max_id = 0
+
+        query = db.session.query(models.Torrent.id, models.Torrent.info_hash) \
+            .order_by(models.Torrent.info_hash) \
+            .yield_per(self.batch_size)
+        for i, (torrent_id, info_hash) in enumerate(query):
+            hashes += info_hash
+            ids.append(torrent_id)
+            max_id = max(max_id, torrent_id)
+            if i % self.batch_size == 0:
+                # Let other greenlets run (time.sleep is gevent's when monkey-patched)
+                time.sleep(0)
+
+        self._hashes = bytes(hashes)
+        self._ids = ids
+        self._recent = {}
+        self._max_id = max_id
+
+    def _load_new_rows(self):
+        ''' Adds torrents with an id above the highest one seen so far '''
+        while True:
+            rows = db.session.query(models.Torrent.id, models.Torrent.info_hash) \
+                .filter(models.Torrent.id > self._max_id) \
+                .order_by(models.Torrent.id) \
+                .limit(self.batch_size).all()
+            if not rows:
+                break
+
+            for torrent_id, info_hash in rows:
+                self._recent[bytes(info_hash)] = torrent_id
+            self._max_id = rows[-1][0]
+
+            if len(self._recent) >= self.merge_threshold:
+                self._merge_recent()
+
+    def refresh(self, force=False):
+        ''' Loads the index (or the torrents added since) if refresh_interval has passed.
+            Returns right away if another thread is already doing it. '''
+        if not force and time.time() - self._last_refresh < self.refresh_interval:
+            return
+
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if not force and time.time() - self._last_refresh < self.refresh_interval:
+                return
+            if self._loaded:
+                self._load_new_rows()
+            else:
+                self._load_all()
+                self._loaded = True
+            self._last_refresh = time.time()
+        finally:
+            self._lock.release()
+
+    def warm(self):
+        ''' Starts the first full load in the background, unless it's already running '''
+        if not self.enabled:
+            return
+        with self._warm_lock:
+            if self._warming:
+                return
+            self._warming = True
+
+        thread = Thread(target=self._warm)
+        thread.daemon = True
+        thread.start()
+
+    def _warm(self):
+        with app.app_context():
+            try:
+                self.refresh(force=True)
+                self._failed_loads = 0
+            except Exception:
+                self._failed_loads += 1
+                retry_delay = min(self.refresh_interval * 2 ** (self._failed_loads - 1),
+                                  MAX_RETRY_DELAY)
+                self._retry_at = time.time() + retry_delay
+                app.logger.exception('Loading the info_hash index failed, retrying in %ds',
+                                     retry_delay)
+            finally:
+                db.session.remove()
+                self._warming = False
+
+    def lookup(self, info_hashes):
+        ''' Returns a dict of {info_hash: torrent_id} for the given hashes that exist.
+            Hashes missing from the index are checked against the database in a
+            single query, in case they were uploaded since the last refresh
+            (or the index is still loading). '''
+        if not self.enabled:
+            return self._lookup_db(info_hashes)
+
+        if self._loaded:
+            self.refresh()
+        elif not self._warming and time.time() >= self._retry_at:
+            # The first load failed (or never started), try again
+            self.warm()
+
+        found = {}
+        missing = []
+        for info_hash in info_hashes:
+            torrent_id = self._find(info_hash)
+            if torrent_id is None:
+                missing.append(info_hash)
+            else:
+                found[info_hash] = torrent_id
+
+        if missing:
+            found_missing = self._lookup_db(missing)
+            found.update(found_missing)
+            # Remember the hits, unless a load holds the lock (it replaces _recent anyway).
+            # Capped, as nothing merges the overlay before the first load finishes.
+            if found_missing and self._lock.acquire(blocking=False):
+                try:
+                    for info_hash, torrent_id in found_missing.items():
+                        if len(self._recent) >= self.merge_threshold:
+                            break
+                        self._recent[info_hash] = torrent_id
+                finally:
+                    self._lock.release()
+
+        return found
+
+    def _lookup_db(self, info_hashes):
+        rows = db.session.query(models.Torrent.id, models.Torrent.info_hash) \
+            .filter(models.Torrent.info_hash.in_(info_hashes)).all()
+        return {bytes(info_hash): torrent_id for torrent_id, info_hash in rows}
+
+
+info_hash_index = InfoHashIndex(enabled=app.config.get('USE_INFO_HASH_INDEX', False),
+                                refresh_interval=app.config.get('INFO_HASH_INDEX_REFRESH', 60))
+
+
+@app.before_first_request
+def _warm_info_hash_index():
+    # Once per worker process, after uWSGI has forked it
+    info_hash_index.warm()
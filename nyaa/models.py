@@ -1,15 +1,20 @@
 from enum import Enum, IntEnum
 from datetime import datetime, timezone
 from nyaa import app, db
+from nyaa import utils
 from nyaa.torrents import create_magnet
-from sqlalchemy import func, ForeignKeyConstraint, Index
+from sqlalchemy import func, event, ForeignKeyConstraint, Index, DDL
+from sqlalchemy.sql import table, column
 from sqlalchemy_utils import ChoiceType, EmailType, PasswordType
 from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy_fulltext import FullText
 from ipaddress import ip_address
 
 import re
+import hmac
 import base64
+import hashlib
+import secrets
 from markupsafe import escape as escape_markup
 from urllib.parse import unquote as unquote_url
 
@@ -206,6 +211,33 @@ class TorrentNameSearch(FullText, Torrent):
     __fulltext_columns__ = ('display_name',)
 
 
+# Without MySQL's FULLTEXT, name search uses an SQLite FTS5 index instead.
+# It's an external content table over the torrents table, kept up to date by triggers.
+TorrentNameFts = table(DB_TABLE_PREFIX + 'torrents_fts', column('rowid'), column('display_name'))
+
+if not app.config['USE_MYSQL']:
+    _fts_ddl_params = {'fts': TorrentNameFts.name, 'torrents': Torrent.__tablename__}
+    _fts_create_statements = [
+        "CREATE VIRTUAL TABLE {fts} USING fts5("
+        "display_name, content='{torrents}', content_rowid='id')",
+        "CREATE TRIGGER {fts}_ai AFTER INSERT ON {torrents} BEGIN "
+        "INSERT INTO {fts}(rowid, display_name) VALUES (new.id, new.display_name); END",
+        "CREATE TRIGGER {fts}_ad AFTER DELETE ON {torrents} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, display_name) "
+        "VALUES ('delete', old.id, old.display_name); END",
+        "CREATE TRIGGER {fts}_au AFTER UPDATE OF display_name ON {torrents} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, display_name) "
+        "VALUES ('delete', old.id, old.display_name); "
+        "INSERT INTO {fts}(rowid, display_name) VALUES (new.id, new.display_name); END",
+    ]
+    for _statement in _fts_create_statements:
+        event.listen(Torrent.__table__, 'after_create',
+                     DDL(_statement.format(**_fts_ddl_params)).execute_if(dialect='sqlite'))
+    event.listen(Torrent.__table__, 'before_drop',
+                 DDL('DROP TABLE IF EXISTS {fts}'.format(**_fts_ddl_params))
+                 .execute_if(dialect='sqlite'))
+
+
 class TorrentFilelist(db.Model):
     __tablename__ = DB_TABLE_PREFIX + 'torrents_filelist'
     __table_args__ = {'mysql_row_format': 'COMPRESSED'}
@@ -242,6 +274,42 @@ class Statistic(db.Model):
     torrent = db.relationship('Torrent', uselist=False, back_populates='stats')
 
 
+class EsOutbox(db.Model):
+    ''' Torrents whose Elasticsearch document needs to be rebuilt, drained by sync_es_outbox.py.
+        Rows are added in the same transaction as the change, see _queue_es_outbox. '''
+    __tablename__ = DB_TABLE_PREFIX + 'es_outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # No foreign key, the row has to outlive a deleted torrent so its document gets removed
+    torrent_id = db.Column(db.Integer, nullable=False)
+    created_time = db.Column(db.DateTime(timezone=False), default=datetime.utcnow)
+
+
+def _queue_es_outbox(session, flush_context):
+    ''' Records every torrent whose row or stats were written in this flush '''
+    torrent_ids = set()
+    for instance in session.new | session.dirty | session.deleted:
+        if isinstance(instance, Torrent):
+            torrent_id = instance.id
+        elif isinstance(instance, Statistic):
+            torrent_id = instance.torrent_id
+        else:
+            continue
+        if torrent_id is not None and (instance not in session.dirty or
+                                       session.is_modified(instance, include_collections=False)):
+            torrent_ids.add(torrent_id)
+
+    if torrent_ids:
+        now = datetime.utcnow()
+        session.connection().execute(
+            EsOutbox.__table__.insert(),
+            [{'torrent_id': torrent_id, 'created_time': now} for torrent_id in sorted(torrent_ids)])
+
+
+if app.config.get('USE_ES_OUTBOX'):
+    event.listen(db.session, 'after_flush', _queue_es_outbox)
+
+
 class Trackers(db.Model):
     __tablename__ = 'trackers'
 
@@ -345,6 +413,8 @@ class User(db.Model):
     created_time = db.Column(db.DateTime(timezone=False), default=datetime.utcnow)
     last_login_date = db.Column(db.DateTime(timezone=False), default=None, nullable=True)
     last_login_ip = db.Column(db.Binary(length=16), default=None, nullable=True)
+    # HMAC-SHA256 of the API token, see generate_api_token
+    api_token = db.Column(BinaryType(length=32), default=None, nullable=True, unique=True)
 
     torrents = db.relationship('Torrent', back_populates='user', lazy="dynamic")
     # session = db.relationship('Session', uselist=False, back_populates='user')
@@ -374,10 +444,42 @@ class User(db.Model):
         if self.last_login_ip:
             return str(ip_address(self.last_login_ip))
 
+    @staticmethod
+    def hash_api_token(token):
+        ''' Hashes an API token with the app secret key. Tokens are long and random,
+            so a fast keyed hash is enough (unlike passwords, which use argon2) '''
+        return hmac.new(app.config['SECRET_KEY'].encode('utf-8'),
+                        token.encode('utf-8'), hashlib.sha256).digest()
+
+    def generate_api_token(self):
+        ''' Replaces the user's API token with a new one and returns it.
+            Only the hash is stored, so the token can't be shown again. '''
+        token = secrets.token_urlsafe(32)
+        self.api_token = self.hash_api_token(token)
+        return token
+
     @classmethod
     def by_id(cls, id):
         return cls.query.get(id)
 
+    @classmethod
+    def snapshot_by_id(cls, id, fresh=False):
+        ''' Returns a (possibly cached) UserSnapshot for the given id,
+            or None if the user does not exist. With fresh, the user is always
+            loaded from the database (and the cached snapshot replaced). '''
+        snapshot = None if fresh else _user_snapshot_cache.get(id)
+        if snapshot is None:
+            user = cls.by_id(id)
+            if not user:
+                return None
+            snapshot = _user_snapshot_cache.set(id, UserSnapshot.from_user(user))
+        return snapshot
+
+    @classmethod
+    def invalidate_snapshot(cls, id):
+        ''' Drops the cached snapshot, call after changing the user's level or status '''
+        _user_snapshot_cache.pop(id)
+
     @classmethod
     def by_username(cls, username):
         user = cls.query.filter_by(username=username).first()
@@ -392,6 +494,10 @@ class User(db.Model):
     def by_username_or_email(cls, username_or_email):
         return cls.by_username(username_or_email) or cls.by_email(username_or_email)
 
+    @classmethod
+    def by_api_token_hash(cls, token_hash):
+        return cls.query.filter_by(api_token=token_hash).first()
+
     @property
     def is_moderator(self):
         return self.level >= UserLevelType.MODERATOR
@@ -405,6 +511,44 @@ class User(db.Model):
         return self.level >= UserLevelType.TRUSTED
 
 
+class UserSnapshot(object):
+    ''' A read-only copy of the User fields needed on most requests.
+        Cached by User.snapshot_by_id so logged in requests don't have to query
+        the users table every time. Load the full User to modify it. '''
+    __slots__ = ('id', 'username', 'level', 'status', 'created_time', 'api_token')
+
+    def __init__(self, id, username, level, status, created_time, api_token):
+        self.id = id
+        self.username = username
+        self.level = level
+        self.status = status
+        self.created_time = created_time
+        self.api_token = api_token
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.level, user.status, user.created_time,
+                   user.api_token)
+
+    def __repr__(self):
+        return '<UserSnapshot %r>' % self.username
+
+    def __eq__(self, other):
+        if isinstance(other, (User, UserSnapshot)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    is_moderator = User.is_moderator
+    is_superadmin = User.is_superadmin
+    is_trusted = User.is_trusted
+
+
+_user_snapshot_cache = utils.TimedCache(ttl=app.config.get('USER_CACHE_TTL', 15))
+
+
 # class Session(db.Model):
 #    __tablename__ = 'sessions'
 #
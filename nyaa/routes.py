@@ -6,10 +6,12 @@ from nyaa import bencode, utils
 from nyaa import torrents
 from nyaa import backend
 from nyaa import api_handler
-from nyaa.search import search_elastic, search_db
+from nyaa.search import search_elastic_or_none, search_db
+from nyaa.search import encode_search_cursor, decode_search_after, es_hits_total
 import config
 
 import json
+import hashlib
 from datetime import datetime, timedelta
 from ipaddress import ip_address
 import os.path
@@ -19,6 +21,8 @@ import math
 from werkzeug import url_encode
 
 from itsdangerous import URLSafeSerializer, BadSignature
+from flask_wtf import FlaskForm
+from flask_wtf.csrf import generate_csrf
 
 import smtplib
 from email.mime.multipart import MIMEMultipart
@@ -27,14 +31,23 @@ from email.utils import formatdate
 
 from flask_paginate import Pagination
 
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import func
+from sqlalchemy.orm import lazyload
+
 
 DEBUG_API = False
 DEFAULT_MAX_SEARCH_RESULT = 1000
 DEFAULT_PER_PAGE = 75
+DEFAULT_STREAM_BUFFER_SIZE = 20
+DEFAULT_ES_FALLBACK_MAX_PAGES = 5
 SERACH_PAGINATE_DISPLAY_MSG = ('Displaying results {start}-{end} out of {total} results.<br>\n'
                                'Please refine your search results if you can\'t find '
                                'what you were looking for.')
 
+# Rendered RSS feeds, keyed on the parameters that affect a public feed
+_rss_cache = utils.TimedCache(ttl=app.config.get('RSS_CACHE_TTL', 60), max_size=1000)
+
 
 def redirect_url():
     url = flask.request.args.get('next') or \
@@ -68,6 +81,31 @@ def category_name(cat_id):
     return ' - '.join(get_category_id_map().get(cat_id, ['???']))
 
 
+def stream_template(template_name, **context):
+    ''' Like flask.render_template, but returns a generator of rendered chunks,
+        so large result pages are sent as they are rendered instead of being
+        built into a single string first. '''
+    # The session is saved before a streamed body is sent, so anything the template
+    # would store in it (consumed flashes, a new CSRF token) has to happen now.
+    flask.get_flashed_messages()
+    if any(isinstance(value, FlaskForm) for value in context.values()):
+        generate_csrf()
+
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    # Group the template's many tiny pieces into reasonably sized writes
+    stream.enable_buffering(app.config.get('STREAM_BUFFER_SIZE', DEFAULT_STREAM_BUFFER_SIZE))
+    return stream
+
+
+def render_results_template(template_name, **context):
+    ''' Renders a template listing torrents, streamed in chunks if STREAM_TEMPLATES is set '''
+    if app.config.get('STREAM_TEMPLATES'):
+        return flask.Response(flask.stream_with_context(stream_template(template_name, **context)))
+    return flask.render_template(template_name, **context)
+
+
 @app.errorhandler(404)
 def not_found(error):
     return flask.render_template('404.html'), 404
@@ -77,7 +115,11 @@ def not_found(error):
 def before_request():
     flask.g.user = None
     if 'user_id' in flask.session:
-        user = models.User.by_id(flask.session['user_id'])
+        # Only a cached snapshot, handlers load the full User if they need to modify it.
+        # Requests that can change something always check the current level and status,
+        # since bans and level changes made in other processes only expire from the cache.
+        fresh = flask.request.method not in ('GET', 'HEAD', 'OPTIONS')
+        user = models.User.snapshot_by_id(flask.session['user_id'], fresh=fresh)
         if not user:
             return logout()
 
@@ -133,6 +175,36 @@ def get_category_id_map():
 # Routes start here #
 
 
+def _get_search_after(req_args, sort):
+    ''' Decodes the ?after= cursor for searching past the numbered ES pages '''
+    cursor = req_args.get('after')
+    if not cursor:
+        return None
+
+    search_after = decode_search_after(cursor, sort)
+    if search_after is None:
+        flask.abort(400)
+    return search_after
+
+
+def _next_search_cursor(query_results, query_args, last_page):
+    ''' Returns a cursor for the results after this page, if they can't be reached by
+        page number (ie. on the last numbered page or already paging by cursor) '''
+    hits = query_results.hits
+    if len(hits) < query_args['per_page']:
+        return None
+    if query_args.get('search_after') is None and query_args['page'] < last_page:
+        return None
+    return encode_search_cursor(list(hits[-1].meta.sort))
+
+
+def _limit_fallback_search(query_args):
+    ''' Caps a term search that fell back to the database because ES is unavailable:
+        fulltext search in the database is much slower, so only serve the first pages '''
+    max_pages = app.config.get('ES_FALLBACK_MAX_PAGES', DEFAULT_ES_FALLBACK_MAX_PAGES)
+    query_args['page'] = min(query_args['page'], max_pages)
+
+
 def chain_get(source, *args):
     ''' Tries to return values from source by the given keys.
         Returns None if none match.
@@ -172,6 +244,18 @@ def home(rss):
     use_magnet_links = 'magnets' in req_args or 'm' in req_args
 
     results_per_page = app.config.get('RESULTS_PER_PAGE', DEFAULT_PER_PAGE)
+    if render_as_rss:
+        results_per_page = app.config.get('RSS_RESULTS_PER_PAGE', results_per_page)
+
+    # Answer repeated polls of the same feed without touching the database or ES.
+    # Moderators see deleted torrents in their feeds, so don't cache those.
+    rss_cache_key = None
+    if render_as_rss and not (flask.g.user and flask.g.user.is_moderator):
+        rss_cache_key = _rss_cache_key(search_term, category, quality_filter, user_name,
+                                       results_per_page, use_magnet_links)
+        cached_feed = _rss_cache.get(rss_cache_key)
+        if cached_feed is not None:
+            return _make_rss_response(*cached_feed)
 
     user_id = None
     if user_name:
@@ -198,58 +282,72 @@ def home(rss):
 
     # If searching, we get results from elastic search
     use_elastic = app.config.get('USE_ELASTIC_SEARCH')
+    query_results = None
     if use_elastic and search_term:
-        query_args['term'] = search_term
+        es_query_args = dict(query_args, term=search_term)
 
         max_search_results = app.config.get('ES_MAX_SEARCH_RESULT', DEFAULT_MAX_SEARCH_RESULT)
 
-        # Only allow up to (max_search_results / page) pages
-        max_page = min(query_args['page'], int(math.ceil(max_search_results / results_per_page)))
+        # Only allow up to (max_search_results / page) pages, deeper results use a cursor
+        last_page = int(math.ceil(max_search_results / results_per_page))
+        max_page = min(query_args['page'], last_page)
 
-        query_args['page'] = max_page
-        query_args['max_search_results'] = max_search_results
+        es_query_args['page'] = max_page
+        es_query_args['max_search_results'] = max_search_results
+        if render_as_rss:
+            # Feeds don't show a total
+            es_query_args['exact_total'] = False
+        else:
+            es_query_args['search_after'] = _get_search_after(req_args, es_query_args['sort'])
 
-        query_results = search_elastic(**query_args)
+        # None if ES is unavailable, in which case we search the database instead
+        query_results = search_elastic_or_none(**es_query_args)
 
+    if query_results is not None:
+        query_args = es_query_args
         if render_as_rss:
             return render_rss(
                 '"{}"'.format(search_term), query_results,
-                use_elastic=True, magnet_links=use_magnet_links)
+                use_elastic=True, magnet_links=use_magnet_links, cache_key=rss_cache_key)
         else:
             rss_query_string = _generate_query_string(
                 search_term, category, quality_filter, user_name)
-            max_results = min(max_search_results, query_results['hits']['total'])
+            total = es_hits_total(query_results)
+            # Only uncounted past ES 7's default limit (10000 hits), which is plenty for pagination
+            max_results = max_search_results if total is None else min(max_search_results, total)
             # change p= argument to whatever you change page_parameter to or pagination breaks
             pagination = Pagination(p=query_args['page'], per_page=results_per_page,
                                     total=max_results, bs_version=3, page_parameter='p',
                                     display_msg=SERACH_PAGINATE_DISPLAY_MSG)
-            return flask.render_template('home.html',
-                                         use_elastic=True,
-                                         pagination=pagination,
-                                         torrent_query=query_results,
-                                         search=query_args,
-                                         rss_filter=rss_query_string)
+            next_cursor = _next_search_cursor(query_results, query_args, last_page)
+            return render_results_template('home.html',
+                                           use_elastic=True,
+                                           pagination=pagination,
+                                           next_cursor=next_cursor,
+                                           torrent_query=query_results,
+                                           search=query_args,
+                                           rss_filter=rss_query_string)
     else:
-        # If ES is enabled, default to db search for browsing
-        if use_elastic:
-            query_args['term'] = ''
-        else:  # Otherwise, use db search for everything
-            query_args['term'] = search_term or ''
+        # If ES is enabled, we only get here when browsing without a term (or ES is down)
+        query_args['term'] = search_term or ''
+        if use_elastic and search_term:
+            _limit_fallback_search(query_args)
 
         query = search_db(**query_args)
         if render_as_rss:
-            return render_rss('Home', query, use_elastic=False, magnet_links=use_magnet_links)
+            return render_rss('Home', query, use_elastic=False,
+                              magnet_links=use_magnet_links, cache_key=rss_cache_key)
         else:
             rss_query_string = _generate_query_string(
                 search_term, category, quality_filter, user_name)
             # Use elastic is always false here because we only hit this section
             # if we're browsing without a search term (which means we default to DB)
-            # or if ES is disabled
-            return flask.render_template('home.html',
-                                         use_elastic=False,
-                                         torrent_query=query,
-                                         search=query_args,
-                                         rss_filter=rss_query_string)
+            # or if ES is disabled or unavailable
+            return render_results_template('home.html',
+                                           use_elastic=False,
+                                           torrent_query=query,
+                                           search=query_args,
+                                           rss_filter=rss_query_string)
 
 
 @app.route('/user/<user_name>', methods=['GET', 'POST'])
@@ -278,6 +376,7 @@ def view_user(user_name):
 
         db.session.add(user)
         db.session.commit()
+        models.User.invalidate_snapshot(user.id)
 
         return flask.redirect(flask.url_for('view_user', user_name=user.username))
 
@@ -321,50 +420,60 @@ def view_user(user_name):
     # Use elastic search for term searching
     rss_query_string = _generate_query_string(search_term, category, quality_filter, user_name)
     use_elastic = app.config.get('USE_ELASTIC_SEARCH')
+    query_results = None
     if use_elastic and search_term:
-        query_args['term'] = search_term
+        es_query_args = dict(query_args, term=search_term)
 
         max_search_results = app.config.get('ES_MAX_SEARCH_RESULT', DEFAULT_MAX_SEARCH_RESULT)
 
-        # Only allow up to (max_search_results / page) pages
-        max_page = min(query_args['page'], int(math.ceil(max_search_results / results_per_page)))
+        # Only allow up to (max_search_results / page) pages, deeper results use a cursor
+        last_page = int(math.ceil(max_search_results / results_per_page))
+        max_page = min(query_args['page'], last_page)
 
-        query_args['page'] = max_page
-        query_args['max_search_results'] = max_search_results
+        es_query_args['page'] = max_page
+        es_query_args['max_search_results'] = max_search_results
+        es_query_args['search_after'] = _get_search_after(req_args, es_query_args['sort'])
 
-        query_results = search_elastic(**query_args)
+        # None if ES is unavailable, in which case we search the database instead
+        query_results = search_elastic_or_none(**es_query_args)
 
-        max_results = min(max_search_results, query_results['hits']['total'])
+    if query_results is not None:
+        query_args = es_query_args
+        next_cursor = _next_search_cursor(query_results, query_args, last_page)
+
+        total = es_hits_total(query_results)
+        # Only uncounted past ES 7's default limit (10000 hits), which is plenty for pagination
+        max_results = max_search_results if total is None else min(max_search_results, total)
         # change p= argument to whatever you change page_parameter to or pagination breaks
         pagination = Pagination(p=query_args['page'], per_page=results_per_page,
                                 total=max_results, bs_version=3, page_parameter='p',
                                 display_msg=SERACH_PAGINATE_DISPLAY_MSG)
-        return flask.render_template('user.html',
-                                     use_elastic=True,
-                                     pagination=pagination,
-                                     torrent_query=query_results,
-                                     search=query_args,
-                                     user=user,
-                                     user_page=True,
-                                     rss_filter=rss_query_string,
-                                     level=user_level,
-                                     admin_form=admin_form)
+        return render_results_template('user.html',
+                                       use_elastic=True,
+                                       pagination=pagination,
+                                       next_cursor=next_cursor,
+                                       torrent_query=query_results,
+                                       search=query_args,
+                                       user=user,
+                                       user_page=True,
+                                       rss_filter=rss_query_string,
+                                       level=user_level,
+                                       admin_form=admin_form)
     # Similar logic as home page
     else:
-        if use_elastic:
-            query_args['term'] = ''
-        else:
-            query_args['term'] = search_term or ''
+        query_args['term'] = search_term or ''
+        if use_elastic and search_term:
+            _limit_fallback_search(query_args)
         query = search_db(**query_args)
-        return flask.render_template('user.html',
-                                     use_elastic=False,
-                                     torrent_query=query,
-                                     search=query_args,
-                                     user=user,
-                                     user_page=True,
-                                     rss_filter=rss_query_string,
-                                     level=user_level,
-                                     admin_form=admin_form)
+        return render_results_template('user.html',
+                                       use_elastic=False,
+                                       torrent_query=query,
+                                       search=query_args,
+                                       user=user,
+                                       user_page=True,
+                                       rss_filter=rss_query_string,
+                                       level=user_level,
+                                       admin_form=admin_form)
 
 
 @app.template_filter('rfc822')
@@ -377,18 +486,111 @@ def _jinja2_filter_rfc822(datestr, fmt=None):
     return formatdate(float(datetime.strptime(datestr, '%Y-%m-%dT%H:%M:%S').strftime('%s')))
 
 
-def render_rss(label, query, use_elastic, magnet_links=False):
-    rss_xml = flask.render_template('rss.xml',
-                                    use_elastic=use_elastic,
-                                    magnet_links=magnet_links,
-                                    term=label,
-                                    site_url=flask.request.url_root,
-                                    torrent_query=query)
-    response = flask.make_response(rss_xml)
+def _rss_cache_key(term, category, quality_filter, user_name, per_page, magnet_links):
+    ''' Normalizes the RSS parameters into a feed cache key. Sorting and paging
+        don't apply to feeds, so they are left out. '''
+    return (flask.request.url_root,
+            (term or '').strip(),
+            category or '0_0',
+            quality_filter or '0',
+            (user_name or '').lower(),
+            per_page,
+            bool(magnet_links))
+
+
+def _rss_validators(torrents, use_elastic):
+    ''' Returns the newest torrent id and the latest change time among the feed items '''
+    newest_id = 0
+    last_modified = None
+    for torrent in torrents:
+        if use_elastic:
+            torrent_id = int(torrent.meta.id)
+            changed = getattr(torrent, 'updated_time', None) or torrent.created_time
+            changed = datetime.strptime(changed[:19], '%Y-%m-%dT%H:%M:%S')
+        else:
+            torrent_id = torrent.id
+            changed = torrent.updated_time or torrent.created_time
+
+        newest_id = max(newest_id, torrent_id)
+        if last_modified is None or changed > last_modified:
+            last_modified = changed
+    return newest_id, last_modified
+
+
+def _rss_db_validators(query):
+    ''' Like _rss_validators for a database feed query, but computed by the database,
+        so the feed rows don't have to be loaded up front '''
+    feed = query.with_entities(models.Torrent.id, models.Torrent.created_time,
+                               models.Torrent.updated_time).subquery()
+    newest_id, last_modified = db.session.query(
+        func.max(feed.c.id),
+        func.max(func.coalesce(feed.c.updated_time, feed.c.created_time))).one()
+    return newest_id or 0, last_modified
+
+
+def _cache_rss_chunks(chunks, cache_key, etag, last_modified):
+    ''' Passes streamed feed chunks through, caching the whole feed once it's done '''
+    rendered = []
+    for chunk in chunks:
+        rendered.append(chunk)
+        yield chunk
+    _rss_cache.set(cache_key, (''.join(rendered), etag, last_modified, True))
+
+
+def _make_rss_response(rss_xml, etag, last_modified, weak_etag=False):
+    # rss_xml is either a string or an iterable of chunks
+    response = flask.Response(rss_xml)
     response.headers['Content-Type'] = 'application/xml'
-    # Cache for an hour
+    # Cache for five minutes
     response.headers['Cache-Control'] = 'max-age={}'.format(1 * 5 * 60)
-    return response
+    response.set_etag(etag, weak=weak_etag)
+    if last_modified:
+        response.last_modified = last_modified
+    # Turns into a 304 on a matching If-None-Match/If-Modified-Since
+    return response.make_conditional(flask.request)
+
+
+def render_rss(label, query, use_elastic, magnet_links=False, cache_key=None):
+    rss_context = dict(use_elastic=use_elastic,
+                       magnet_links=magnet_links,
+                       term=label,
+                       site_url=flask.request.url_root,
+                       torrent_query=query)
+
+    if app.config.get('STREAM_TEMPLATES'):
+        # The body isn't known up front, so this is a weak ETag on the newest item only.
+        # Conditional requests may miss stats changes until the feed gets a new item.
+        if use_elastic or not isinstance(query, BaseQuery):
+            # The hits (or rows) are all loaded already
+            newest_id, last_modified = _rss_validators(query, use_elastic)
+        else:
+            newest_id, last_modified = _rss_db_validators(query)
+            # Load the rows in batches as the template gets to them. The trackers aren't
+            # rendered, and eager loading a collection doesn't work with yield_per.
+            rss_context['torrent_query'] = query.options(
+                lazyload(models.Torrent.trackers)).yield_per(100)
+        etag = '{}-{}'.format(newest_id, last_modified and last_modified.isoformat())
+
+        chunks = stream_template('rss.xml', **rss_context)
+        if cache_key is not None:
+            chunks = _cache_rss_chunks(chunks, cache_key, etag, last_modified)
+
+        return _make_rss_response(flask.stream_with_context(chunks), etag, last_modified,
+                                  weak_etag=True)
+
+    # Evaluate the query once, it's iterated for both the template and the validators
+    torrents = list(query)
+    rss_context['torrent_query'] = torrents
+    rss_xml = flask.render_template('rss.xml', **rss_context)
+
+    # Stats in the feed change without new uploads, so the body hash is part of the ETag too
+    newest_id, last_modified = _rss_validators(torrents, use_elastic)
+    etag = '{}-{}'.format(newest_id, hashlib.sha1(rss_xml.encode('utf-8')).hexdigest()[:16])
+
+    if cache_key is not None:
+        _rss_cache.set(cache_key, (rss_xml, etag, last_modified, False))
+
+    return _make_rss_response(rss_xml, etag, last_modified)
 
 
 # @app.route('/about', methods=['GET'])
@@ -479,10 +681,8 @@ def profile():
 
     form = forms.ProfileForm(flask.request.form)
 
-    level = ['Regular', 'Trusted', 'Moderator', 'Administrator'][flask.g.user.level]
-
     if flask.request.method == 'POST' and form.validate():
-        user = flask.g.user
+        user = models.User.by_id(flask.g.user.id)
         new_email = form.email.data.strip()
         new_password = form.new_password.data
 
@@ -506,16 +706,49 @@ def profile():
 
         db.session.add(user)
         db.session.commit()
+        models.User.invalidate_snapshot(user.id)
 
         flask.g.user = user
         return flask.redirect('/profile')
 
+    return _render_profile(form)
+
+
+def _render_profile(form, new_api_token=None):
     _user = models.User.by_id(flask.g.user.id)
     username = _user.username
     current_email = _user.email
+    level = ['Regular', 'Trusted', 'Moderator', 'Administrator'][_user.level]
 
     return flask.render_template('profile.html', form=form, name=username, email=current_email,
-                                 level=level)
+                                 level=level, api_token_form=forms.ApiTokenForm(),
+                                 has_api_token=bool(_user.api_token),
+                                 new_api_token=new_api_token)
+
+
+@app.route('/profile/api_token', methods=['POST'])
+def regenerate_api_token():
+    if not flask.g.user:
+        return flask.redirect('/')
+
+    form = forms.ApiTokenForm(flask.request.form)
+    if form.validate():
+        user = models.User.by_id(flask.g.user.id)
+        if user.api_token:
+            api_handler.invalidate_api_token(user.api_token)
+
+        api_token = user.generate_api_token()
+        db.session.add(user)
+        db.session.commit()
+        models.User.invalidate_snapshot(user.id)
+
+        # Shown in this response only, not flashed, which would keep it in the session cookie
+        response = flask.make_response(
+            _render_profile(forms.ProfileForm(), new_api_token=api_token))
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    return flask.redirect('/profile')
 
 
 @app.route('/user/activate/<payload>')
@@ -535,6 +768,7 @@ def activate_user(payload):
 
     db.session.add(user)
     db.session.commit()
+    models.User.invalidate_snapshot(user.id)
 
     return flask.redirect('/login')
 
@@ -584,7 +818,7 @@ def view_torrent(torrent_id):
         flask.abort(404)
 
     # Only allow owners and admins to edit torrents
-    can_edit = viewer and (viewer is torrent.user or viewer.is_moderator)
+    can_edit = viewer and (viewer.id == torrent.uploader_id or viewer.is_moderator)
 
     files = None
     if torrent.filelist:
@@ -612,7 +846,7 @@ def edit_torrent(torrent_id):
         flask.abort(404)
 
     # Only allow torrent owners or admins edit torrents
-    if not editor or not (editor is torrent.user or editor.is_moderator):
+    if not editor or not (editor.id == torrent.uploader_id or editor.is_moderator):
         flask.abort(403)
 
     if flask.request.method == 'POST' and form.validate():
@@ -3,24 +3,183 @@ import re
 import math
 import json
 import shlex
+import base64
+import binascii
+import functools
 
 from nyaa import app, db
 from nyaa import models
+from nyaa import utils
 
 import sqlalchemy_fulltext.modes as FullTextMode
 from sqlalchemy_fulltext import FullTextSearch
+from sqlalchemy import select
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ElasticsearchException, TransportError
+from elasticsearch.exceptions import ConnectionError as ESConnectionError
 from elasticsearch_dsl import Search, Q
 
-
+# The document fields search_results.html and rss.xml use (id comes from the hit meta),
+# so ES doesn't ship the rest of _source with every hit
+ES_SOURCE_FIELDS = [
+    'display_name',
+    'created_time',
+    'updated_time',
+    'info_hash',
+    'filesize',
+    'main_category_id',
+    'sub_category_id',
+    'anonymous',
+    'trusted',
+    'remake',
+    'complete',
+    'hidden',
+    'deleted',
+    'has_torrent',
+    'seed_count',
+    'leech_count',
+    'download_count',
+]
+
+
+_search_flight = utils.SingleFlight()
+
+# One client (and connection pool) per process, with a timeout that bounds how long
+# a search can hold up a greenlet
+es_client = Elasticsearch(timeout=app.config.get('ES_SEARCH_TIMEOUT', 5))
+
+
+def _es_bad_request(exception):
+    ''' Whether ES rejected the search itself (a 4xx response), rather than failing '''
+    return (isinstance(exception, TransportError) and isinstance(exception.status_code, int) and
+            400 <= exception.status_code < 500)
+
+
+def _es_unavailable(exception):
+    ''' Whether a search failed because of ES: no connection or a timeout, a 5xx response,
+        or the greenlet being interrupted while waiting on it (gevent.Timeout, GreenletExit) '''
+    if not isinstance(exception, Exception) or isinstance(exception, ESConnectionError):
+        return True
+    return (isinstance(exception, TransportError) and isinstance(exception.status_code, int) and
+            exception.status_code >= 500)
+
+
+# Stops sending searches to ES while it's erroring or slow, see search_elastic_or_none
+es_breaker = utils.CircuitBreaker(
+    slow_call_time=app.config.get('ES_SLOW_SEARCH_TIME', 2),
+    reset_timeout=app.config.get('ES_BREAKER_RESET_TIME', 30),
+    is_failure=_es_unavailable)
+
+# Last good ES results for recent searches, served while ES is unavailable
+_es_fallback_cache = utils.TimedCache(ttl=app.config.get('ES_FALLBACK_CACHE_TTL', 600),
+                                      max_size=app.config.get('ES_FALLBACK_CACHE_SIZE', 1000))
+
+
+def _search_key_value(value):
+    ''' Normalizes a search argument for use in a coalescing key '''
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, list):
+        return tuple(value)
+    if hasattr(value, 'id'):
+        # logged_in_user, only the id affects the results
+        return value.id
+    return value
+
+
+def coalesced_search(f):
+    ''' Makes concurrent identical calls to a search function share one backend query,
+        so a burst of the same search (eg. right after a release) costs one query.
+        Only for searches returning plain data: ORM instances belong to the session
+        of the greenlet that loaded them, so search_db is never coalesced. '''
+    @functools.wraps(f)
+    def decorator(**kwargs):
+        if not app.config.get('COALESCE_SEARCHES', True):
+            return f(**kwargs)
+        return _search_flight.do(_search_key(f.__name__, kwargs), lambda: f(**kwargs))
+    return decorator
+
+
+def _search_key(name, kwargs):
+    return (name,) + tuple(sorted(
+        (arg, _search_key_value(value)) for arg, value in kwargs.items()))
+
+
+def search_elastic_or_none(**kwargs):
+    ''' Like search_elastic, but returns None instead of failing when ES is down or
+        the circuit breaker is open. If the same search succeeded recently, those
+        results are returned instead, so callers only fall back to the database
+        for searches we have nothing for. A search ES rejects as invalid is a 400. '''
+    key = _search_key('search_elastic', kwargs)
+    try:
+        results = search_elastic(**kwargs)
+    except utils.CircuitOpenError:
+        return _es_fallback_cache.get(key)
+    except ElasticsearchException as e:
+        if _es_bad_request(e):
+            app.logger.info('Elasticsearch rejected a search: %r', e)
+            flask.abort(400)
+        app.logger.warning('Elasticsearch search failed: %r', e)
+        return _es_fallback_cache.get(key)
+
+    _es_fallback_cache.set(key, results)
+    return results
+
+
+def encode_search_cursor(position):
+    ''' Turns a JSON-able position (eg. the sort values of the last hit) into an opaque string '''
+    return base64.urlsafe_b64encode(
+        json.dumps(position, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_search_cursor(cursor):
+    ''' Reverse of encode_search_cursor, returns None for a malformed cursor '''
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, binascii.Error, UnicodeError):
+        return None
+
+
+def decode_search_after(cursor, sort='id'):
+    ''' Decodes a cursor made from hit.meta.sort for search_elastic(search_after=...)
+        with the given sort, returns None if it isn't one. The sort fields are all
+        integers: the sorted field, then the id as a tiebreaker (unless sorting by id). '''
+    search_after = decode_search_cursor(cursor)
+    expected_length = 1 if sort.lower() == 'id' else 2
+    if (not isinstance(search_after, list) or len(search_after) != expected_length or
+            not all(type(value) is int for value in search_after)):
+        return None
+    return search_after
+
+
+def es_hits_total(results):
+    ''' Returns the number of hits ES counted, or None if it didn't count them all
+        (see exact_total). ES 5/6 report -1 for that, ES 7+ report {"value": n,
+        "relation": "eq"/"gte"}, or nothing at all. '''
+    try:
+        total = results['hits']['total']
+    except KeyError:
+        return None
+    if not isinstance(total, int):
+        if total['relation'] != 'eq':
+            return None
+        total = total['value']
+    return total if total >= 0 else None
+
+
+@coalesced_search
 def search_elastic(term='', user=None, sort='id', order='desc',
                    category='0_0', quality_filter='0', page=1,
                    rss=False, admin=False, logged_in_user=None,
-                   per_page=75, max_search_results=1000):
+                   per_page=75, max_search_results=1000, source_fields=None,
+                   search_after=None, exact_total=True):
+    ''' Searches ES, returning a page of results. Pages past max_search_results
+        can't be reached by number, instead pass the sort values of the last hit
+        (hit.meta.sort) as search_after to get the next per_page results after it.
+        Pass exact_total=False if hits.total isn't needed, which lets an index sorted
+        by id (see ES_INDEX_SORTED) stop searching after the newest matches. '''
     # This function can easily be memcached now
 
-    es_client = Elasticsearch()
-
     es_sort_keys = {
         'id': 'id',
         'size': 'filesize',
@@ -102,7 +261,16 @@ def search_elastic(term='', user=None, sort='id', order='desc',
     if logged_in_user:
         same_user = user == logged_in_user.id
 
-    s = Search(using=es_client, index=app.config.get('ES_INDEX_NAME'))  # todo, sukebei prefix
+    # With ES_HIDDEN_INDEX_NAME set, hidden and deleted torrents are kept out of the main
+    # index, so searches that could only show public torrents don't need to filter them out
+    hidden_index = app.config.get('ES_HIDDEN_INDEX_NAME')
+    public_only = bool(hidden_index) and not admin and \
+        (rss or not logged_in_user or bool(user and not same_user))
+    indices = [app.config.get('ES_INDEX_NAME')]  # todo, sukebei prefix
+    if hidden_index and not public_only:
+        indices.append(hidden_index)
+
+    s = Search(using=es_client, index=indices)
 
     # Apply search term
     if term:
@@ -117,7 +285,8 @@ def search_elastic(term='', user=None, sort='id', order='desc',
 
         if not admin:
             # Hide all DELETED torrents if regular user
-            s = s.filter('term', deleted=False)
+            if not public_only:
+                s = s.filter('term', deleted=False)
             # If logged in user is not the same as the user being viewed,
             # show only torrents that aren't hidden or anonymous.
             #
@@ -127,11 +296,12 @@ def search_elastic(term='', user=None, sort='id', order='desc',
             # On RSS pages in user view, show only torrents that
             # aren't hidden or anonymous no matter what
             if not same_user or rss:
-                s = s.filter('term', hidden=False)
+                if not public_only:
+                    s = s.filter('term', hidden=False)
                 s = s.filter('term', anonymous=False)
     # General view (homepage, general search view)
     else:
-        if not admin:
+        if not admin and not public_only:
             # Hide all DELETED torrents if regular user
             s = s.filter('term', deleted=False)
             # If logged in, show all torrents that aren't hidden unless they belong to you
@@ -159,12 +329,26 @@ def search_elastic(term='', user=None, sort='id', order='desc',
     elif quality_filter == 3:
         s = s.filter('term', complete=True)
 
-    # Apply sort
-    s = s.sort(es_sort)
+    # Apply sort, with the id as a tiebreaker so search_after positions are unique
+    if es_sort.lstrip('-') == 'id':
+        s = s.sort(es_sort)
+    else:
+        s = s.sort(es_sort, '-id' if order == 'desc' else 'id')
+
+    # With the index sorted by id desc, newest-first searches can stop early once enough
+    # hits are collected, but only if they don't need to count every match
+    if not exact_total and es_sort == '-id' and app.config.get('ES_INDEX_SORTED'):
+        s = s.extra(track_total_hits=False)
+
+    # Only fetch the fields we render
+    s = s.source(source_fields if source_fields is not None else ES_SOURCE_FIELDS)
 
     # Only show first RESULTS_PER_PAGE items for RSS
     if rss:
         s = s[0:per_page]
+    elif search_after is not None:
+        # Cursor paging: costs the same however deep it goes, and has no result limit
+        s = s.extra(search_after=search_after)[0:per_page]
     else:
         max_page = min(page, int(math.ceil(max_search_results / float(per_page))))
         from_idx = (max_page - 1) * per_page
@@ -179,7 +363,42 @@ def search_elastic(term='', user=None, sort='id', order='desc',
     # Return query, uncomment print line to debug query
     # from pprint import pprint
     # print(json.dumps(s.to_dict()))
-    return s.execute()
+    return _overlay_hot_stats(es_breaker.call(s.execute))
+
+
+def _overlay_hot_stats(results):
+    ''' Replaces the counts in the hits with the ones in ES_STATS_INDEX, which sync_es.py
+        updates on every change while the torrent documents only get them now and then '''
+    stats_index = app.config.get('ES_STATS_INDEX')
+    if not stats_index or not results.hits:
+        return results
+
+    try:
+        response = es_client.mget(index=stats_index, doc_type='stats',
+                                  body={'ids': [hit.meta.id for hit in results]})
+    except ElasticsearchException as e:
+        # The counts in the torrent documents are a bit older, but fine
+        app.logger.warning('Fetching stats from Elasticsearch failed: %r', e)
+        return results
+
+    counts = {doc['_id']: doc['_source'] for doc in response['docs'] if doc.get('found')}
+    for hit in results:
+        for field, value in counts.get(hit.meta.id, {}).items():
+            setattr(hit, field, value)
+    return results
+
+
+def _fts5_match_query(term):
+    ''' Turns a search term into an FTS5 query matching every word in it.
+        Each word is quoted as a phrase, so FTS5 operators in the term are literal. '''
+    phrases = []
+    for item in shlex.split(term, posix=False):
+        if len(item) < 2:
+            continue
+        item = item.strip('"')
+        if item:
+            phrases.append('"' + item.replace('"', '""') + '"')
+    return ' '.join(phrases)
 
 
 def search_db(term='', user=None, sort='id', order='desc', category='0_0',
@@ -257,7 +476,7 @@ def search_db(term='', user=None, sort='id', order='desc', category='0_0',
     if logged_in_user:
         same_user = logged_in_user.id == user
 
-    if term:
+    if term and app.config['USE_MYSQL']:
         query = db.session.query(models.TorrentNameSearch)
     else:
         query = models.Torrent.query
@@ -308,11 +527,17 @@ def search_db(term='', user=None, sort='id', order='desc', category='0_0',
         query = query.filter(models.Torrent.flags.op('&')(
             int(filter_tuple[0])).is_(filter_tuple[1]))
 
-    if term:
+    if term and app.config['USE_MYSQL']:
         for item in shlex.split(term, posix=False):
             if len(item) >= 2:
                 query = query.filter(FullTextSearch(
                     item, models.TorrentNameSearch, FullTextMode.NATURAL))
+    elif term:
+        fts_query = _fts5_match_query(term)
+        if fts_query:
+            fts = models.TorrentNameFts
+            query = query.filter(models.Torrent.id.in_(
+                select([fts.c.rowid]).where(fts.c.display_name.op('MATCH')(fts_query))))
 
     # Sort and order
     if sort.class_ != models.Torrent:
@@ -0,0 +1,141 @@
+import os
+import unittest
+from datetime import datetime
+
+import yaml
+
+from nyaa import es_docs
+from nyaa.models import TorrentFlags
+
+MAPPING_PATH = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'es_mapping.yml')
+
+# What the document values have to be for each mapping type
+MAPPING_TYPES = {
+    'long': int,
+    'boolean': bool,
+    'date': datetime,
+    'text': str,
+    # The ids are numbers, es indexes them as strings
+    'keyword': (int, type(None)),
+}
+
+
+def load_mapping():
+    with open(MAPPING_PATH) as f:
+        return yaml.safe_load(f)['mappings']['torrent']
+
+
+def make_row(id=1, flags=0, with_stats=True, **kwargs):
+    values = {
+        'id': id,
+        'display_name': 'Some torrent',
+        'created_time': datetime(2017, 5, 1, 12, 0, 0),
+        'updated_time': datetime(2017, 5, 2, 12, 0, 0),
+        'info_hash': bytes(range(id, id + 20)),
+        'filesize': 1024,
+        'uploader_id': 3,
+        'main_category_id': 1,
+        'sub_category_id': 2,
+        'flags': flags,
+        'has_torrent': 1,
+        'download_count': 10,
+        'leech_count': 2,
+        'seed_count': 5,
+    }
+    values.update(kwargs)
+    fields = es_docs.TORRENT_FIELDS + (es_docs.STATS_FIELDS if with_stats else ())
+    return tuple(values[field] for field in fields)
+
+
+class TestEsDocs(unittest.TestCase):
+
+    def setUp(self):
+        self.mapping = load_mapping()
+        self.properties = self.mapping['properties']
+
+    def test_fields_match_mapping(self):
+        doc = es_docs.torrent_doc(make_row())
+        self.assertEqual(set(doc), set(self.properties))
+
+    def test_values_match_mapping_types(self):
+        doc = es_docs.torrent_doc(make_row(uploader_id=None))
+        for field, prop in self.properties.items():
+            if 'type' in prop:
+                self.assertIsInstance(doc[field], MAPPING_TYPES[prop['type']], field)
+
+    def test_no_excluded_fields(self):
+        doc = es_docs.torrent_doc(make_row())
+        excludes = self.mapping['_source']['excludes']
+        self.assertFalse(set(doc) & set(excludes))
+
+    def test_without_stats(self):
+        doc = es_docs.torrent_doc(make_row(with_stats=False), with_stats=False)
+        self.assertEqual(set(doc), set(self.properties) - set(es_docs.STATS_FIELDS))
+
+        stats = es_docs.stats_doc({'torrent_id': 1, 'download_count': 10,
+                                   'leech_count': 2, 'seed_count': None})
+        self.assertEqual(stats, {'download_count': 10, 'leech_count': 2, 'seed_count': 0})
+
+    def test_missing_stats(self):
+        doc = es_docs.torrent_doc(make_row(download_count=None, leech_count=None,
+                                           seed_count=None))
+        for field in es_docs.STATS_FIELDS:
+            self.assertEqual(doc[field], 0)
+
+    def test_flags_and_info_hash(self):
+        doc = es_docs.torrent_doc(make_row(flags=TorrentFlags.TRUSTED | TorrentFlags.HIDDEN))
+        flags = {field: doc[field] for field, _ in es_docs.FLAG_FIELDS}
+        self.assertEqual(flags, {'anonymous': False, 'trusted': True, 'remake': False,
+                                 'complete': False, 'hidden': True, 'deleted': False})
+        self.assertEqual(doc['info_hash'], bytes(range(1, 21)).hex())
+
+    def test_is_public(self):
+        for flags, public in ((0, True), (TorrentFlags.ANONYMOUS | TorrentFlags.TRUSTED, True),
+                              (TorrentFlags.HIDDEN, False), (TorrentFlags.DELETED, False)):
+            doc = es_docs.torrent_doc(make_row(flags=flags))
+            self.assertEqual(es_docs.is_public(doc), public, flags)
+            self.assertEqual(es_docs.is_public_flags(flags), public, flags)
+
+    def test_flags_match_model(self):
+        for flag in TorrentFlags:
+            if flag != TorrentFlags.NONE:
+                self.assertEqual(getattr(es_docs, flag.name), flag, flag.name)
+
+    def test_batch(self):
+        rows = [
+            make_row(id=1),
+            make_row(id=2, flags=TorrentFlags.ANONYMOUS | TorrentFlags.REMAKE |
+                     TorrentFlags.COMPLETE | TorrentFlags.DELETED,
+                     display_name='Another torrent', uploader_id=None, has_torrent=0,
+                     download_count=None, leech_count=None, seed_count=None),
+        ]
+        common = {
+            'created_time': datetime(2017, 5, 1, 12, 0, 0),
+            'updated_time': datetime(2017, 5, 2, 12, 0, 0),
+            'filesize': 1024,
+            'main_category_id': 1,
+            'sub_category_id': 2,
+            'trusted': False,
+            'hidden': False,
+        }
+        expected = [
+            dict(common, id=1, display_name='Some torrent', uploader_id=3,
+                 anonymous=False, remake=False, complete=False, deleted=False, has_torrent=True,
+                 info_hash='0102030405060708090a0b0c0d0e0f1011121314',
+                 download_count=10, leech_count=2, seed_count=5),
+            dict(common, id=2, display_name='Another torrent', uploader_id=None,
+                 anonymous=True, remake=True, complete=True, deleted=True, has_torrent=False,
+                 info_hash='02030405060708090a0b0c0d0e0f101112131415',
+                 download_count=0, leech_count=0, seed_count=0),
+        ]
+        self.assertEqual(es_docs.torrent_docs(rows), expected)
+        self.assertEqual(es_docs.torrent_docs([]), [])
+
+    def test_dict_rows(self):
+        row = make_row()
+        fields = es_docs.TORRENT_FIELDS + es_docs.STATS_FIELDS
+        self.assertEqual(es_docs.torrent_doc(dict(zip(fields, row))), es_docs.torrent_doc(row))
+
+
+if __name__ == '__main__':
+    unittest.main()
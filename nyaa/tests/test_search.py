@@ -0,0 +1,143 @@
+import os
+import tempfile
+import unittest
+
+import gevent
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from nyaa import app, db, models
+from nyaa import routes, search
+
+TORRENT_COUNT = 5
+
+
+def setUpModule():
+    if app.config['USE_MYSQL']:
+        raise unittest.SkipTest('The search tests run against a temporary SQLite database')
+
+    global db_fd, db_path
+    db_fd, db_path = tempfile.mkstemp(suffix='.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path + '?check_same_thread=False'
+    app.config['TESTING'] = True
+    app.config['USE_ELASTIC_SEARCH'] = False
+    db.create_all()
+
+    main_cat = models.MainCategory(name='Anime')
+    sub_cat = models.SubCategory(id=1, name='Raw', main_category=main_cat)
+    user = models.User(username='uploader', email='uploader@example.com', password='password')
+    user.status = models.UserStatusType.ACTIVE
+    db.session.add_all([main_cat, sub_cat, user])
+    for i in range(1, TORRENT_COUNT + 1):
+        torrent = models.Torrent(id=i, info_hash=bytes([i] * 20),
+                                 display_name='Torrent {}'.format(i),
+                                 torrent_name='torrent{}.torrent'.format(i), information='',
+                                 description='', filesize=1024 * i, encoding='utf-8',
+                                 user=user, main_category=main_cat, sub_category_id=1)
+        torrent.stats = models.Statistic(seed_count=i, leech_count=0, download_count=0)
+        db.session.add(torrent)
+    db.session.commit()
+    db.session.remove()
+
+
+def tearDownModule():
+    db.session.remove()
+    db.drop_all()
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+class SlowQueries(object):
+    ''' Yields to other greenlets before every query, so concurrent searches overlap '''
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self._yield)
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self._yield)
+
+    @staticmethod
+    def _yield(*args):
+        gevent.sleep(0.01)
+
+
+class TestSearchDb(unittest.TestCase):
+
+    def setUp(self):
+        self._coalesce = app.config.get('COALESCE_SEARCHES')
+        app.config['COALESCE_SEARCHES'] = True
+
+    def tearDown(self):
+        app.config['COALESCE_SEARCHES'] = self._coalesce
+
+    def test_concurrent_searches_use_own_session(self):
+        def render_results():
+            with app.test_request_context():
+                try:
+                    results = search.search_db(sort='id', order='desc', page=1, per_page=10)
+                    for torrent in results.items:
+                        # Loaded into this greenlet's session, not a coalesced one
+                        self.assertIs(object_session(torrent), db.session())
+                    return [(torrent.display_name, torrent.sub_category.name,
+                             torrent.stats.seed_count, torrent.user.username)
+                            for torrent in results.items]
+                finally:
+                    db.session.remove()
+
+        with SlowQueries():
+            greenlets = [gevent.spawn(render_results) for _ in range(2)]
+            gevent.joinall(greenlets, raise_error=True)
+
+        expected = [('Torrent {}'.format(i), 'Raw', i, 'uploader')
+                    for i in range(TORRENT_COUNT, 0, -1)]
+        for greenlet in greenlets:
+            self.assertEqual(greenlet.value, expected)
+
+    def test_concurrent_pages_render(self):
+        client = app.test_client()
+
+        def render_page():
+            return client.get('/')
+
+        with SlowQueries():
+            greenlets = [gevent.spawn(render_page) for _ in range(2)]
+            gevent.joinall(greenlets, raise_error=True)
+
+        for greenlet in greenlets:
+            self.assertEqual(greenlet.value.status_code, 200)
+            body = greenlet.value.get_data(as_text=True)
+            for i in range(1, TORRENT_COUNT + 1):
+                self.assertIn('Torrent {}'.format(i), body)
+
+
+class TestRss(unittest.TestCase):
+
+    def setUp(self):
+        self._config = {key: app.config.get(key)
+                        for key in ('STREAM_TEMPLATES', 'COALESCE_SEARCHES')}
+        app.config['STREAM_TEMPLATES'] = True
+        app.config['COALESCE_SEARCHES'] = True
+        routes._rss_cache.clear()
+
+    def tearDown(self):
+        app.config.update(self._config)
+        routes._rss_cache.clear()
+
+    def test_streamed_db_feed(self):
+        client = app.test_client()
+        response = client.get('/?page=rss')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'application/xml')
+        self.assertTrue(response.headers['ETag'].startswith('W/"{}-'.format(TORRENT_COUNT)))
+        body = response.get_data(as_text=True)
+        for i in range(1, TORRENT_COUNT + 1):
+            self.assertIn('Torrent {}'.format(i), body)
+
+        # Served from the feed cache the second time
+        cached = client.get('/?page=rss')
+        self.assertEqual(cached.status_code, 200)
+        self.assertEqual(cached.get_data(as_text=True), body)
+
+
+if __name__ == '__main__':
+    unittest.main()
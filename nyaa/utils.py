@@ -1,6 +1,8 @@
 import hashlib
 import functools
-from collections import OrderedDict
+import time
+import threading
+from collections import OrderedDict, deque
 
 
 def sha1_hash(input_bytes):
@@ -35,6 +37,177 @@ def cached_function(f):
     return decorator
 
 
+class TimedCache(object):
+    ''' A small in-process dict cache where every entry expires after a given
+        number of seconds. Expired entries are dropped lazily on access, and the
+        oldest entries are evicted once max_size is reached. '''
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        expires, value = entry
+        if expires < time.monotonic():
+            self._entries.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        self._entries.pop(key, None)
+        while len(self._entries) >= self.max_size:
+            self._entries.popitem(last=False)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        return value
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SingleFlight(object):
+    ''' Coalesces concurrent calls with the same key: the first caller runs the
+        function while the others wait for it and get the same result (or exception).
+        Nothing is kept once the call finishes, so this adds no staleness.
+        If the first caller is interrupted (a gevent.Timeout or GreenletExit, which
+        belong to its greenlet alone), the others try again themselves.
+        Uses threading primitives, which gevent monkey-patches to be greenlet-aware. '''
+
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.interrupted = False
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, f, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = self._Call()
+
+        if not is_leader:
+            call.done.wait()
+            if call.interrupted:
+                return self.do(key, f, *args, **kwargs)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = f(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException:
+            call.interrupted = True
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class CircuitOpenError(Exception):
+    ''' Raised by CircuitBreaker.call instead of calling an unavailable service '''
+    pass
+
+
+class CircuitBreaker(object):
+    ''' Stops calling a failing or slow service for a while, so callers fail fast
+        instead of each waiting for a timeout.
+
+        A call fails if it takes longer than slow_call_time seconds, or raises an exception
+        is_failure(exception) is true for (by default, any). Other exceptions are passed
+        on but count as a success, eg. for errors in the request rather than the service.
+        When at least failure_rate of the last window_size calls have failed, the
+        circuit opens and calls raise CircuitOpenError for reset_timeout seconds.
+        After that a single trial call is let through, and its outcome either
+        closes the circuit or keeps it open for another reset_timeout. '''
+
+    def __init__(self, window_size=20, failure_rate=0.5, slow_call_time=2.0, reset_timeout=30,
+                 is_failure=None):
+        self.failure_rate = failure_rate
+        self.slow_call_time = slow_call_time
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure or (lambda exception: True)
+
+        self._outcomes = deque(maxlen=window_size)
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        ''' Whether calls are currently being refused '''
+        if self._opened_at is None:
+            return False
+        return self._trial_running or \
+            time.monotonic() - self._opened_at < self.reset_timeout
+
+    def call(self, f, *args, **kwargs):
+        is_trial = False
+        with self._lock:
+            if self._opened_at is not None:
+                if self.is_open:
+                    raise CircuitOpenError()
+                # Half-open, this call is the trial
+                self._trial_running = is_trial = True
+
+        start = time.monotonic()
+        try:
+            result = f(*args, **kwargs)
+        except BaseException as e:
+            # Including a gevent.Timeout or GreenletExit, so a trial always ends
+            self._record(not self.is_failure(e) and self._is_fast(start), is_trial)
+            raise
+        self._record(self._is_fast(start), is_trial)
+        return result
+
+    def _is_fast(self, start):
+        return time.monotonic() - start <= self.slow_call_time
+
+    def _record(self, success, is_trial):
+        with self._lock:
+            if is_trial:
+                self._trial_running = False
+                if success:
+                    self._opened_at = None
+                    self._outcomes.clear()
+                else:
+                    self._opened_at = time.monotonic()
+                return
+            if self._opened_at is not None:
+                # Started before the circuit opened, too late to matter
+                return
+
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if (len(self._outcomes) == self._outcomes.maxlen and
+                    failures >= self.failure_rate * len(self._outcomes)):
+                self._opened_at = time.monotonic()
+
+
 def flattenDict(d, result=None):
     if result is None:
         result = {}
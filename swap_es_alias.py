@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Point the ES_INDEX_NAME alias (nyaa or sukebei) at a new versioned index,
+atomically, so searches go from the old index to the new one with nothing
+in between. See "Rebuilding the ES index" in the README for the whole
+workflow.
+
+If ES_INDEX_NAME is still a plain index from before versioned indices, it's
+deleted in the same step, since the alias can't exist next to it.
+Old versioned indices are kept unless --delete-old is given, so you can
+swap back if something's off.
+"""
+from nyaa import app
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import NotFoundError
+import argparse
+import sys
+
+parser = argparse.ArgumentParser(description='Atomically point the search alias at an index.')
+parser.add_argument('index', help='the index to swap in, like nyaa_v2')
+parser.add_argument('--alias', default=app.config['ES_INDEX_NAME'],
+                    help='alias to move, defaults to ES_INDEX_NAME')
+parser.add_argument('--delete-old', action='store_true',
+                    help='delete the indices the alias pointed to before')
+args = parser.parse_args()
+
+es = Elasticsearch(timeout=30)
+
+if not es.indices.exists(index=args.index):
+    print(f"index {args.index} doesn't exist", file=sys.stderr)
+    sys.exit(1)
+
+actions = []
+try:
+    old_indices = list(es.indices.get_alias(name=args.alias))
+except NotFoundError:
+    old_indices = []
+    if es.indices.exists(index=args.alias):
+        # a plain index from before versioned indices
+        print(f"deleting the unversioned index {args.alias}")
+        actions.append({'remove_index': {'index': args.alias}})
+
+for old_index in old_indices:
+    if old_index == args.index:
+        continue
+    if args.delete_old:
+        actions.append({'remove_index': {'index': old_index}})
+    else:
+        actions.append({'remove': {'index': old_index, 'alias': args.alias}})
+actions.append({'add': {'index': args.index, 'alias': args.alias}})
+
+es.indices.update_aliases(body={'actions': actions})
+print(f"{args.alias} -> {args.index} (was {', '.join(old_indices) or 'nothing'})")
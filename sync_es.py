@@ -21,23 +21,42 @@ when import_to_es and sync_es will be lost. Instead, you can run SHOW MASTER
 STATUS _before_ you run import_to_es. That way you'll definitely pick up any
 changes that happen while the import_to_es script is dumping stuff from the
 database into es, at the expense of redoing a (small) amount of indexing.
+`import_to_es.py --pos-file` does exactly that, and writes the position
+file for you.
 
-This uses multithreading so we don't have to block on socket io (both binlog
-reading and es POSTing). asyncio soon™
+The binlog is read on its own thread (the reader library is synchronous) and
+fed into an asyncio pipeline. Actions are spread over `es_concurrency` sender
+lanes by document, each of which sends one bulk request at a time, so several
+chunks are in flight at once while the updates to any one document still
+reach es in binlog order. Within a chunk, the actions for each document are
+merged first, so a torrent whose stats changed a hundred times is sent once. The saved position only ever moves past events whose
+actions have all been acknowledged by es, so after a crash or an es outage
+nothing is skipped; at worst a few events are indexed twice.
 """
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk, BulkIndexError
+from elasticsearch.helpers import streaming_bulk
 from pymysqlreplication import BinLogStreamReader
+import pymysql
 from pymysqlreplication.row_event import UpdateRowsEvent, DeleteRowsEvent, WriteRowsEvent
 from datetime import datetime
-from nyaa.models import TorrentFlags
+import importlib.util
+import os
 import sys
 import json
+import pickle
 import time
 import logging
 from statsd import StatsClient
-from threading import Thread
-from queue import Queue, Empty
+from threading import Thread, Lock
+from collections import deque, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+
+# Loaded from its file, as importing it through the nyaa package would set up the whole web app
+_es_docs_spec = importlib.util.spec_from_file_location(
+    'es_docs', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nyaa', 'es_docs.py'))
+es_docs = importlib.util.module_from_spec(_es_docs_spec)
+_es_docs_spec.loader.exec_module(es_docs)
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s - %(message)s')
 
@@ -45,8 +64,9 @@ log = logging.getLogger('sync_es')
 log.setLevel(logging.INFO)
 
 # config in json, 2lazy to argparse
-if len(sys.argv) != 2:
-    print("need config.json location", file=sys.stderr)
+if len(sys.argv) not in (2, 3) or sys.argv[2:] not in ([], ['replay']):
+    print("need config.json location, and optionally 'replay' to resend the dead letters",
+          file=sys.stderr)
     sys.exit(-1)
 with open(sys.argv[1]) as f:
     config = json.load(f)
@@ -63,50 +83,90 @@ MYSQL_PORT = config.get('mysql_port', 3306)
 MYSQL_USER = config.get('mysql_user', 'root')
 MYSQL_PW = config.get('mysql_password', 'dunnolol')
 NT_DB = config.get('database', 'nyaav2')
+# replication id, arbitrary but unique per binlog reader: mysql drops a
+# connection when another one shows up with the same id
+SERVER_ID = config.get('server_id', 10)
 INTERNAL_QUEUE_DEPTH = config.get('internal_queue_depth', 10000)
+# chunk sizes adapt between these two, aiming for bulk requests taking
+# es_target_bulk_time seconds at most
 ES_CHUNK_SIZE = config.get('es_chunk_size', 10000)
+ES_MIN_CHUNK_SIZE = config.get('es_min_chunk_size', 100)
+ES_TARGET_BULK_TIME = config.get('es_target_bulk_time', 2)
+# retrying rejected actions, with the wait doubling from es_initial_backoff seconds
+ES_MAX_RETRIES = config.get('es_max_retries', 8)
+ES_INITIAL_BACKOFF = config.get('es_initial_backoff', 1)
+ES_MAX_BACKOFF = config.get('es_max_backoff', 60)
+# actions es refuses for good end up here
+DEAD_LETTER_LOC = config.get('dead_letter_loc', "/tmp/sync_es_dead_letter.jsonl")
+# bulk requests in flight at once
+ES_CONCURRENCY = config.get('es_concurrency', 4)
 # seconds since no events happening to flush to es. remember this also
 # interacts with es' refresh_interval setting.
 FLUSH_INTERVAL = config.get('flush_interval', 5)
+# es to sync to, a list of hosts for the Elasticsearch client. default localhost
+ES_HOSTS = config.get('es_hosts')
+# index (or alias) each site's changes go to. point these at a new versioned
+# index, with its own save_loc, to catch it up before swapping the alias to it.
+ES_INDEX_NAMES = dict({'nyaa': 'nyaa', 'sukebei': 'sukebei'}, **config.get('es_index_names', {}))
+# for benchmarking offline: record_loc saves the binlog events read to a
+# file, which can later be fed through again instead of the binlog with
+# replay_loc. see also utils/fake_es.py, to stand in for es.
+RECORD_LOC = config.get('record_loc')
+REPLAY_LOC = config.get('replay_loc')
+# stats updates too small to be worth a write to es, see StatsFilter. The
+# defaults only hold back updates that don't change any count.
+STATS_MIN_ABSOLUTE_CHANGE = config.get('stats_min_absolute_change', 0)
+STATS_MIN_RELATIVE_CHANGE = config.get('stats_min_relative_change', 0)
+STATS_MIN_INTERVAL = config.get('stats_min_interval', 0)
+STATS_SWEEP_INTERVAL = config.get('stats_sweep_interval', 300)
+# torrents whose last sent stats are remembered, least recently updated ones
+# are forgotten past this. a forgotten torrent's next update is just sent.
+STATS_MAX_TRACKED = config.get('stats_max_tracked', 200000)
+# hot stats index per site, like {"nyaa": "nyaa_stats"}, made by create_es.sh.
+# every stats change is written to it right away as a tiny document of its own,
+# which the app shows on result pages (ES_STATS_INDEX); the torrent documents,
+# which sorting uses, only get the counts through StatsFilter, so you can hold
+# those back a lot longer (stats_min_interval) without showing stale counts.
+ES_STATS_INDEX_NAMES = config.get('es_stats_index_names', {})
+# index per site for hidden and deleted torrents, like {"nyaa": "nyaa_hidden"},
+# matching the app's ES_HIDDEN_INDEX_NAME. torrents move between it and the
+# main index as they're hidden or deleted and back, so the main index only
+# has public ones. moving a document copies its current stats over, so the
+# mysql user also needs SELECT on the statistics tables. stats changes only
+# go to the main index, so hidden torrents' counts are as of when they moved
+# (ES_STATS_INDEX_NAMES still gets them all).
+ES_HIDDEN_INDEX_NAMES = config.get('es_hidden_index_names', {})
 
-def reindex_torrent(t, index_name):
-    # XXX annoyingly different from import_to_es, and
-    # you need to keep them in sync manually.
-    f = t['flags']
-    doc = {
-        "id": t['id'],
-        "display_name": t['display_name'],
-        "created_time": t['created_time'],
-        "updated_time": t['updated_time'],
-        "description": t['description'],
-        # not analyzed but included so we can render magnet links
-        # without querying sql again.
-        "info_hash": t['info_hash'].hex(),
-        "filesize": t['filesize'],
-        "uploader_id": t['uploader_id'],
-        "main_category_id": t['main_category_id'],
-        "sub_category_id": t['sub_category_id'],
-        # XXX all the bitflags are numbers
-        "anonymous": bool(f & TorrentFlags.ANONYMOUS),
-        "trusted": bool(f & TorrentFlags.TRUSTED),
-        "remake": bool(f & TorrentFlags.REMAKE),
-        "complete": bool(f & TorrentFlags.COMPLETE),
-        # TODO instead of indexing and filtering later
-        # could delete from es entirely. Probably won't matter
-        # for at least a few months.
-        "hidden": bool(f & TorrentFlags.HIDDEN),
-        "deleted": bool(f & TorrentFlags.DELETED),
-        "has_torrent": bool(t['has_torrent']),
-    }
-    # update, so we don't delete the stats if present
-    return {
-        '_op_type': 'update',
-        '_index': index_name,
-        '_type': 'torrent',
-        '_id': str(t['id']),
-        "doc": doc,
-        "doc_as_upsert": True
-    }
+def torrent_index(flags, index_name, hidden_index_name):
+    # where a torrent's document lives, see ES_HIDDEN_INDEX_NAMES
+    if hidden_index_name and not es_docs.is_public_flags(flags):
+        return hidden_index_name
+    return index_name
+
+def reindex_torrents(rows, index_name, hidden_index_name=None, moved_stats=None):
+    # the documents come from nyaa.es_docs, same as import_to_es.
+    # update, so we don't delete the stats if present.
+    # moved_stats has the current stats of the torrents that were just hidden
+    # or deleted or made public again, which are moved to their new index.
+    moved_stats = moved_stats or {}
+    actions = []
+    for doc in es_docs.torrent_docs(rows, with_stats=False):
+        target, other = index_name, hidden_index_name
+        if hidden_index_name and not es_docs.is_public(doc):
+            target, other = hidden_index_name, index_name
+        if doc['id'] in moved_stats:
+            doc.update(moved_stats[doc['id']])
+        actions.append({
+            '_op_type': 'update',
+            '_index': target,
+            '_type': 'torrent',
+            '_id': str(doc['id']),
+            "doc": doc,
+            "doc_as_upsert": True
+        })
+        if doc['id'] in moved_stats:
+            actions.append(delet_this(doc['id'], other))
+    return actions
 
 def reindex_stats(s, index_name):
     # update the torrent at torrent_id, assumed to exist;
@@ -118,28 +178,129 @@ def reindex_stats(s, index_name):
         '_index': index_name,
         '_type': 'torrent',
         '_id': str(s['torrent_id']),
-        "doc": {
-            "stats_last_updated": s["last_updated"],
-            "download_count": s["download_count"],
-            "leech_count": s['leech_count'],
-            "seed_count": s['seed_count'],
-        }}
-
-def delet_this(row, index_name):
+        "doc": es_docs.stats_doc(s)}
+
+def hot_stats(s, index_name):
+    # the whole document, so it doesn't matter if it was there before
+    return {
+        '_op_type': 'index',
+        '_index': index_name,
+        '_type': 'stats',
+        '_id': str(s['torrent_id']),
+        '_source': es_docs.stats_doc(s)}
+
+def delet_this(torrent_id, index_name, doc_type='torrent'):
     return {
         "_op_type": 'delete',
         '_index': index_name,
-        '_type': 'torrent',
-        '_id': str(row['values']['id'])}
+        '_type': doc_type,
+        '_id': str(torrent_id)}
+
+
+# running counts, for the replay report
+totals = Counter()
+
+class Checkpoint:
+    """
+    Binlog events in read order, with how many of their actions es hasn't
+    acknowledged yet. `pos` is the position after the last event that
+    es has all of, which is the only safe place to resume from. Only
+    touched from the event loop, so no locking.
+    """
+    def __init__(self):
+        self.events = deque()
+        self.pos = None
 
+    def add(self, pos, action_count):
+        event = [pos, action_count]
+        self.events.append(event)
+        self._advance()
+        return event
+
+    def ack(self, event):
+        event[1] -= 1
+        self._advance()
+
+    def _advance(self):
+        while self.events and self.events[0][1] == 0:
+            self.pos = self.events.popleft()[0]
+
+EVENT_TYPES = {t.__name__: t for t in (WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent)}
+
+def record_events(events, record_loc):
+    """
+    Passes binlog events through, pickling each to record_loc as it goes, for
+    benchmarking sync_es offline later with `replay_loc`.
+    """
+    with open(record_loc, 'ab') as f:
+        for pos, event_type, table, rows in events:
+            pickle.dump((pos, event_type.__name__, table, rows), f)
+            f.flush()
+            yield pos, event_type, table, rows
+
+def replay_events(replay_loc):
+    """
+    Reads events recorded by record_events, as fast as the pipeline takes them.
+    Timestamps are replaced with the time they're read, so process_latency
+    measures sync_es itself.
+    """
+    log.info(f"replaying binlog events from {replay_loc}")
+    with open(replay_loc, 'rb') as f:
+        while True:
+            try:
+                (log_file, log_pos, _), event_type, table, rows = pickle.load(f)
+            except EOFError:
+                break
+            yield (log_file, log_pos, time.time()), EVENT_TYPES[event_type], table, rows
 
 class BinlogReader(Thread):
-    # write_buf is the Queue we communicate with
-    def __init__(self, write_buf):
+    # write_buf is the asyncio Queue we communicate with, on loop
+    def __init__(self, write_buf, loop):
         Thread.__init__(self)
         self.write_buf = write_buf
+        self.loop = loop
+        # fails if reading the binlog does, so the whole thing stops
+        self.done = loop.create_future()
+        # for reading the stats of torrents moving between indices
+        self.mysql = None
+
+    def put(self, pos, actions):
+        # blocks while the queue is full
+        asyncio.run_coroutine_threadsafe(self.write_buf.put((pos, actions)), self.loop).result()
+
+    def current_stats(self, site, torrent_ids):
+        """
+        The stats of the torrents as they are now, for the documents being moved
+        to the other index (see ES_HIDDEN_INDEX_NAMES), so they keep their counts.
+        Torrents without a statistics row get zeros.
+        """
+        if REPLAY_LOC:
+            # not necessarily the database the recording came from
+            found = {}
+        else:
+            if self.mysql is None:
+                self.mysql = pymysql.connect(host=MYSQL_HOST, port=MYSQL_PORT, user=MYSQL_USER,
+                                             password=MYSQL_PW, db=NT_DB, autocommit=True,
+                                             cursorclass=pymysql.cursors.DictCursor)
+            self.mysql.ping(reconnect=True)
+            with self.mysql.cursor() as cursor:
+                cursor.execute(f"SELECT torrent_id, {', '.join(es_docs.STATS_FIELDS)} "
+                               f"FROM {site}_statistics WHERE torrent_id IN %s",
+                               (list(torrent_ids),))
+                found = {row['torrent_id']: es_docs.stats_doc(row) for row in cursor}
+        return {torrent_id: found.get(torrent_id, dict.fromkeys(es_docs.STATS_FIELDS, 0))
+                for torrent_id in torrent_ids}
 
     def run(self):
+        try:
+            self.read_binlog()
+        except Exception as e:
+            self.loop.call_soon_threadsafe(self.done.set_exception, e)
+        else:
+            # only happens when replaying a recording
+            self.loop.call_soon_threadsafe(self.done.set_result, None)
+
+    def stream_binlog(self):
         with open(SAVE_LOC) as f:
             pos = json.load(f)
 
@@ -151,7 +312,7 @@ class BinlogReader(Thread):
                     'user': MYSQL_USER,
                     'passwd': MYSQL_PW
                 },
-                server_id=10, # arbitrary
+                server_id=SERVER_ID,
                 # only care about this database currently
                 only_schemas=[NT_DB],
                 # these tables in the database
@@ -171,137 +332,485 @@ class BinlogReader(Thread):
         log.info(f"reading binlog from {stream.log_file}/{stream.log_pos}")
 
         for event in stream:
-            # save the pos of the stream and timestamp with each message, so we
-            # can commit in the other thread. and keep track of process latency
+            # save the pos of the stream and timestamp with each event, so we
+            # can checkpoint once es has it. and keep track of process latency
             pos = (stream.log_file, stream.log_pos, event.timestamp)
+            yield pos, type(event), event.table, event.rows
+
+    def read_binlog(self):
+        if REPLAY_LOC:
+            events = replay_events(REPLAY_LOC)
+        else:
+            events = self.stream_binlog()
+        if RECORD_LOC:
+            events = record_events(events, RECORD_LOC)
+
+        for pos, event_type, table, rows in events:
             with stats.pipeline() as s:
                 s.incr('total_events')
-                s.incr(f"event.{event.table}.{type(event).__name__}")
-                s.incr('total_rows', len(event.rows))
-                s.incr(f"rows.{event.table}.{type(event).__name__}", len(event.rows))
+                s.incr(f"event.{table}.{event_type.__name__}")
+                s.incr('total_rows', len(rows))
+                s.incr(f"rows.{table}.{event_type.__name__}", len(rows))
                 # XXX not a "timer", but we get a histogram out of it
-                s.timing(f"rows_per_event.{event.table}.{type(event).__name__}", len(event.rows))
+                s.timing(f"rows_per_event.{table}.{event_type.__name__}", len(rows))
 
-            if event.table == "nyaa_torrents" or event.table == "sukebei_torrents":
-                if event.table == "nyaa_torrents":
-                    index_name = "nyaa"
-                else:
-                    index_name = "sukebei"
-                if type(event) is WriteRowsEvent:
-                    for row in event.rows:
-                        self.write_buf.put(
-                                (pos, reindex_torrent(row['values'], index_name)),
-                                block=True)
-                elif type(event) is UpdateRowsEvent:
-                    # UpdateRowsEvent includes the old values too, but we don't care
-                    for row in event.rows:
-                        self.write_buf.put(
-                                (pos, reindex_torrent(row['after_values'], index_name)),
-                                block=True)
-                elif type(event) is DeleteRowsEvent:
+            site = table.split('_')[0]
+            stats_index_name = ES_STATS_INDEX_NAMES.get(site)
+            hidden_index_name = ES_HIDDEN_INDEX_NAMES.get(site)
+            if table == "nyaa_torrents" or table == "sukebei_torrents":
+                index_name = ES_INDEX_NAMES[site]
+                if event_type is WriteRowsEvent:
+                    actions = reindex_torrents([row['values'] for row in rows], index_name,
+                                               hidden_index_name)
+                elif event_type is UpdateRowsEvent:
+                    # the old values only matter for moving documents between
+                    # the main and hidden indices
+                    moved_stats = {}
+                    if hidden_index_name:
+                        moved = [row['after_values']['id'] for row in rows
+                                 if es_docs.is_public_flags(row['before_values']['flags']) !=
+                                 es_docs.is_public_flags(row['after_values']['flags'])]
+                        if moved:
+                            moved_stats = self.current_stats(site, moved)
+                    actions = reindex_torrents([row['after_values'] for row in rows], index_name,
+                                               hidden_index_name, moved_stats)
+                elif event_type is DeleteRowsEvent:
                     # ok, bye
-                    for row in event.rows:
-                        self.write_buf.put((pos, delet_this(row, index_name)), block=True)
+                    actions = [delet_this(row['values']['id'],
+                                          torrent_index(row['values']['flags'], index_name,
+                                                        hidden_index_name))
+                               for row in rows]
+                    if stats_index_name:
+                        actions += [delet_this(row['values']['id'], stats_index_name, 'stats')
+                                    for row in rows]
                 else:
-                    raise Exception(f"unknown event {type(event)}")
-            elif event.table == "nyaa_statistics" or event.table == "sukebei_statistics":
-                if event.table == "nyaa_statistics":
-                    index_name = "nyaa"
-                else:
-                    index_name = "sukebei"
-                if type(event) is WriteRowsEvent:
-                    for row in event.rows:
-                        self.write_buf.put(
-                                (pos, reindex_stats(row['values'], index_name)),
-                                block=True)
-                elif type(event) is UpdateRowsEvent:
-                    for row in event.rows:
-                        self.write_buf.put(
-                                (pos, reindex_stats(row['after_values'], index_name)),
-                                block=True)
-                elif type(event) is DeleteRowsEvent:
+                    raise Exception(f"unknown event {event_type}")
+            elif table == "nyaa_statistics" or table == "sukebei_statistics":
+                index_name = ES_INDEX_NAMES[site]
+                if event_type is WriteRowsEvent:
+                    changed = [row['values'] for row in rows]
+                elif event_type is UpdateRowsEvent:
+                    changed = [row['after_values'] for row in rows]
+                elif event_type is DeleteRowsEvent:
                     # uh ok. Assume that the torrent row will get deleted later,
                     # which will clean up the entire es "torrent" document
-                    pass
+                    changed = []
                 else:
-                    raise Exception(f"unknown event {type(event)}")
+                    raise Exception(f"unknown event {event_type}")
+                # stats rows don't say which index the torrent is in, so only
+                # the main one is updated. hidden torrents' counts go stale in
+                # the hidden index (their updates here are an expected
+                # "document missing", counted apart in post_bulk), and are
+                # caught up when they move back, see reindex_torrents.
+                actions = [reindex_stats(s, index_name) for s in changed]
+                if stats_index_name:
+                    actions += [hot_stats(s, stats_index_name) for s in changed]
             else:
-              raise Exception(f"unknown table {s.table}")
+                raise Exception(f"unknown table {table}")
 
-class EsPoster(Thread):
-    # read_buf is the queue of stuff to bulk post
-    def __init__(self, read_buf, chunk_size=1000, flush_interval=5):
-        Thread.__init__(self)
+            # events without actions still go through, so the checkpoint can pass them
+            totals['events'] += 1
+            totals['actions'] += len(actions)
+            self.put(pos, actions)
+
+STATS_FIELDS = set(es_docs.STATS_FIELDS)
+
+def is_stats_update(action):
+    return action['_op_type'] == 'update' and action['doc'].keys() == STATS_FIELDS
+
+class StatsFilter:
+    """
+    Holds back stats updates that don't change much since the last ones sent
+    for the torrent: significant ones move a count by at least
+    stats_min_absolute_change or stats_min_relative_change of its last sent
+    value, no sooner than stats_min_interval seconds after the last. Seeders or
+    leechers dropping to or rising from 0 always go out right away.
+
+    The latest held back update of each torrent is sent by the sweep every
+    stats_sweep_interval seconds, so es ends up with the final values anyway.
+    Until then its event isn't acknowledged, so the checkpoint can't move past
+    it and lose it in a restart.
+
+    Only the max_tracked most recently updated torrents' last sent stats are
+    kept, so memory doesn't grow with every torrent ever updated.
+    """
+    def __init__(self, checkpoint, min_absolute_change, min_relative_change, min_interval,
+                 max_tracked):
+        self.checkpoint = checkpoint
+        self.min_absolute_change = min_absolute_change
+        self.min_relative_change = min_relative_change
+        self.min_interval = min_interval
+        self.max_tracked = max_tracked
+        # doc -> (time, stats doc) last sent to es, least recently sent first
+        self.sent = OrderedDict()
+        # doc -> (event, action) held back
+        self.held = {}
+
+    def significant(self, doc, counts, now):
+        if doc not in self.sent:
+            return True
+        sent_time, sent_counts = self.sent[doc]
+        for field in ('seed_count', 'leech_count'):
+            if (sent_counts[field] == 0) != (counts[field] == 0):
+                return True
+        if now - sent_time < self.min_interval:
+            return False
+        for field, sent_value in sent_counts.items():
+            change = abs(counts[field] - sent_value)
+            if change and (change >= self.min_absolute_change or
+                           change >= self.min_relative_change * sent_value):
+                return True
+        return False
+
+    def offer(self, event, action):
+        """ Returns whether to send the stats update now, otherwise holds it back """
+        doc = (action['_index'], action['_id'])
+        now = time.time()
+        # either way this supersedes whatever was held back before
+        self.drop(doc)
+        if self.significant(doc, action['doc'], now):
+            self.remember(doc, now, action['doc'])
+            return True
+        self.held[doc] = (event, action)
+        return False
+
+    def remember(self, doc, now, counts):
+        self.sent[doc] = (now, counts)
+        self.sent.move_to_end(doc)
+        if len(self.sent) > self.max_tracked:
+            self.sent.popitem(last=False)
+
+    def drop(self, doc):
+        held = self.held.pop(doc, None)
+        if held:
+            self.checkpoint.ack(held[0])
+
+    def forget(self, doc):
+        # the document's deleted
+        self.drop(doc)
+        self.sent.pop(doc, None)
+
+    def sweep(self):
+        now = time.time()
+        held, self.held = self.held, {}
+        for doc, (_, action) in held.items():
+            self.remember(doc, now, action['doc'])
+        return list(held.values())
+
+async def route(lanes, event, action):
+    # every action for a document goes to the same lane, which keeps
+    # them in order even with other lanes' bulk requests in flight
+    lane = lanes[hash((action['_index'], action['_id'])) % len(lanes)]
+    await lane.put((event, action))
+
+async def dispatch(read_buf, lanes, checkpoint, stats_filter):
+    while True:
+        pos, actions = await read_buf.get()
+        event = checkpoint.add(pos, len(actions))
+        for action in actions:
+            if action['_op_type'] == 'delete':
+                stats_filter.forget((action['_index'], action['_id']))
+            elif is_stats_update(action) and not stats_filter.offer(event, action):
+                stats.incr('stats_held_back')
+                continue
+            await route(lanes, event, action)
+
+async def sweep_stats(lanes, stats_filter):
+    while True:
+        await asyncio.sleep(STATS_SWEEP_INTERVAL)
+        held = stats_filter.sweep()
+        stats.incr('stats_swept', len(held))
+        for event, action in held:
+            await route(lanes, event, action)
+
+def coalesce(actions):
+    """
+    Merges the actions for each document into as few as give the same end
+    result: consecutive updates become one update with their docs merged (later
+    values win, so a hot torrent's stats only go out once), and a delete or a
+    whole-document index drops everything before it. An update after a delete (a re-insert) has to stay
+    separate. Returns the actions grouped by document, otherwise in order.
+    """
+    by_doc = {}
+    for action in actions:
+        doc_actions = by_doc.setdefault((action['_index'], action['_id']), [])
+        if action['_op_type'] in ('delete', 'index'):
+            doc_actions[:] = [action]
+        elif doc_actions and doc_actions[-1]['_op_type'] == 'update':
+            previous = doc_actions[-1]
+            merged = dict(previous)
+            merged['doc'] = dict(previous['doc'], **action['doc'])
+            if action.get('doc_as_upsert'):
+                merged['doc_as_upsert'] = True
+            doc_actions[-1] = merged
+        else:
+            doc_actions.append(action)
+    return [action for doc_actions in by_doc.values() for action in doc_actions]
+
+# responses worth retrying: es overloaded (429/503), and connection errors/timeouts
+RETRY_STATUSES = {429, 503, 'N/A'}
+
+# main indices whose sites have a hidden index, where stats updates for hidden
+# torrents are expected to miss
+HIDDEN_MODE_INDEX_NAMES = {ES_INDEX_NAMES[site] for site in ES_HIDDEN_INDEX_NAMES}
+
+def expected_miss(action, result):
+    return (action['_index'] in HIDDEN_MODE_INDEX_NAMES and is_stats_update(action) and
+            result.get('error', {}).get('type') == 'document_missing_exception')
+
+def ignorable_error(op_type, result):
+    # in certain cases where we're really out of sync, we update a
+    # stat when the torrent doc is, causing a "document missing"
+    # error from es, with no way to suppress that server-side.
+    # deleting a document that's already gone is fine too.
+    if op_type == 'update':
+        return result.get('error', {}).get('type') == 'document_missing_exception'
+    return op_type == 'delete' and result.get('status') == 404
+
+def json_default(o):
+    if isinstance(o, datetime):
+        return o.isoformat()
+    return str(o)
+
+dead_letter_lock = Lock()
+
+def dead_letter(failed):
+    """
+    Appends actions es wouldn't take to the dead-letter file, one JSON object
+    per line, for `sync_es.py config.json replay` once the cause is fixed.
+    """
+    stats.incr('dead_lettered', len(failed))
+    log.error(f"writing {len(failed)} failed actions to {DEAD_LETTER_LOC}")
+    with dead_letter_lock, open(DEAD_LETTER_LOC, 'a') as f:
+        for action, error in failed:
+            f.write(json.dumps({'action': action, 'error': error}, default=json_default) + '\n')
+
+def post_bulk(es, actions):
+    """
+    Posts the actions as one bulk request, retrying just the ones es rejected
+    with exponential backoff. Returns how long the first attempt took and how
+    many of its actions were rejected, for sizing the next chunks, plus the
+    actions that failed for good, with their errors.
+    """
+    pending = actions
+    failed = []
+    for attempt in range(ES_MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(min(ES_MAX_BACKOFF, ES_INITIAL_BACKOFF * 2 ** (attempt - 1)))
+            stats.incr('bulk_retried', len(pending))
+
+        retry = []
+        # once one action for a document is retried, so are the later ones,
+        # so they still reach es in order
+        retry_docs = set()
+        start = time.time()
+        with stats.timer('post_bulk'):
+            results = streaming_bulk(es, pending, chunk_size=len(pending),
+                                     raise_on_error=False, raise_on_exception=False)
+            for action, (ok, item) in zip(pending, results):
+                doc = (action['_index'], action['_id'])
+                op_type, result = item.popitem()
+                if doc in retry_docs or (not ok and result.get('status') in RETRY_STATUSES):
+                    retry.append(action)
+                    retry_docs.add(doc)
+                elif ok:
+                    continue
+                elif expected_miss(action, result):
+                    stats.incr('hidden_stats_missed')
+                elif ignorable_error(op_type, result):
+                    stats.incr(f"ignored_errors.{op_type}")
+                else:
+                    result.pop('exception', None)
+                    failed.append((action, result))
+
+        if not attempt:
+            took, rejected = time.time() - start, len(retry)
+        if retry:
+            stats.incr('bulk_rejected', len(retry))
+        if not retry:
+            break
+        pending = retry
+    else:
+        failed += [(action, {'error': 'still rejected after retries'}) for action in retry]
+
+    return took, rejected, failed
+
+class ChunkSizer:
+    """
+    Picks the bulk chunk size from how es is coping: halved when a bulk
+    request takes longer than target_time or gets anything rejected, and
+    grown by half when full chunks go through in under half of it.
+    Shared by all the lanes, since they all hit the same cluster.
+    """
+    def __init__(self, min_size, max_size, target_time):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_time = target_time
+        self.size = max_size
+
+    def record(self, chunk_length, took, rejected):
+        if rejected or took > self.target_time:
+            self.size = max(self.min_size, self.size // 2)
+        elif chunk_length >= self.size and took < self.target_time / 2:
+            self.size = min(self.max_size, self.size + self.size // 2)
+        stats.gauge('chunk_size', self.size)
+
+class EsPoster:
+    # read_buf is this lane's queue of (event, action) to bulk post
+    def __init__(self, es, executor, read_buf, checkpoint, sizer, flush_interval=5):
+        self.es = es
+        self.executor = executor
         self.read_buf = read_buf
-        self.chunk_size = chunk_size
+        self.checkpoint = checkpoint
+        self.sizer = sizer
         self.flush_interval = flush_interval
 
-    def run(self):
-        es = Elasticsearch(timeout=30)
+    async def next_chunk(self):
+        loop = asyncio.get_event_loop()
+        # wait as long as it takes for the first one, then up to
+        # flush_interval for the chunk to fill up
+        chunk = [await self.read_buf.get()]
+        deadline = loop.time() + self.flush_interval
+        while len(chunk) < self.sizer.size:
+            try:
+                chunk.append(self.read_buf.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            # not wait_for(), it can drop an item that arrives right as it times out
+            getter = asyncio.ensure_future(self.read_buf.get())
+            done, _ = await asyncio.wait([getter], timeout=deadline - loop.time())
+            if not done:
+                getter.cancel()
+                break
+            chunk.append(getter.result())
+        return chunk
 
-        last_save = time.time()
-        since_last = 0
+    async def run(self):
+        loop = asyncio.get_event_loop()
 
         while True:
-            actions = []
-            while len(actions) < self.chunk_size:
-                try:
-                    # grab next event from queue with metadata that creepily
-                    # updates, surviving outside the scope of the loop
-                    ((log_file, log_pos, timestamp), action) = \
-                            self.read_buf.get(block=True, timeout=self.flush_interval)
-                    actions.append(action)
-                except Empty:
-                    # nothing new for the whole interval
-                    break
-
-            if not actions:
-                # nothing to post
-                log.debug("no changes...")
-                continue
+            chunk = await self.next_chunk()
+            actions = coalesce(action for _, action in chunk)
 
             # XXX "time" to get histogram of no events per bulk
+            stats.timing('actions_per_chunk', len(chunk))
             stats.timing('actions_per_bulk', len(actions))
+            totals['bulk_requests'] += 1
+            totals['bulk_actions'] += len(actions)
 
-            try:
-                with stats.timer('post_bulk'):
-                    bulk(es, actions, chunk_size=self.chunk_size)
-            except BulkIndexError as bie:
-                 # in certain cases where we're really out of sync, we update a
-                 # stat when the torrent doc is, causing a "document missing"
-                 # error from es, with no way to suppress that server-side.
-                 # Thus ignore that type of error if it's the only problem
-                for e in bie.errors:
-                    try:
-                        if e['update']['error']['type'] != 'document_missing_exception':
-                            raise bie
-                    except KeyError:
-                        raise bie
+            took, rejected, failed = await loop.run_in_executor(
+                self.executor, post_bulk, self.es, actions)
+            self.sizer.record(len(chunk), took, rejected)
+
+            # rather than stopping the sync on something es won't ever take,
+            # set it aside and carry on
+            if failed:
+                await loop.run_in_executor(self.executor, dead_letter, failed)
+
+            for event, _ in chunk:
+                self.checkpoint.ack(event)
 
             # how far we're behind, wall clock
+            (_, _, timestamp), _ = chunk[-1][0]
             stats.gauge('process_latency', int((time.time() - timestamp) * 1000))
 
-            since_last += len(actions)
-            if since_last >= 10000 or (time.time() - last_save) > 10:
-                log.info(f"saving position {log_file}/{log_pos}, {time.time() - timestamp:,.3f} seconds behind")
-                with stats.timer('save_pos'):
-                    with open(SAVE_LOC, 'w') as f:
-                        json.dump({"log_file": log_file, "log_pos": log_pos}, f)
-                last_save = time.time()
-                since_last = 0
+async def save_position(checkpoint, interval=10):
+    saved = None
+    while True:
+        await asyncio.sleep(interval)
+        if checkpoint.pos is None or checkpoint.pos == saved:
+            continue
+        log_file, log_pos, timestamp = checkpoint.pos
+        log.info(f"saving position {log_file}/{log_pos}, {time.time() - timestamp:,.3f} seconds behind")
+        with stats.timer('save_pos'):
+            with open(SAVE_LOC, 'w') as f:
+                json.dump({"log_file": log_file, "log_pos": log_pos}, f)
+        saved = checkpoint.pos
 
-# in-memory queue between binlog and es. The bigger it is, the more events we
+async def monitor(read_buf, lanes, checkpoint):
+    while True:
+        queue_depth = read_buf.qsize() + sum(lane.qsize() for lane in lanes)
+        totals['max_queue_depth'] = max(totals['max_queue_depth'], queue_depth)
+        stats.gauge('queue_depth', queue_depth)
+        stats.gauge('pending_events', len(checkpoint.events))
+        await asyncio.sleep(1)
+
+async def finish_replay(reader, lanes, checkpoint, stats_filter):
+    """ Waits for a replayed recording to be fully acknowledged, then reports how it went """
+    start = time.time()
+    await reader.done
+    # no point waiting for the sweep
+    for event, action in stats_filter.sweep():
+        await route(lanes, event, action)
+    while checkpoint.events:
+        await asyncio.sleep(0.1)
+
+    took = time.time() - start
+    log.info(f"replayed {totals['events']:,} events ({totals['actions']:,} actions) "
+             f"in {took:,.1f} seconds, {totals['events'] / took:,.0f} events/s; "
+             f"sent {totals['bulk_actions']:,} actions in {totals['bulk_requests']:,} "
+             f"bulk requests, max queue depth {totals['max_queue_depth']:,}")
+
+def replay_dead_letter():
+    """
+    Sends the dead-lettered actions again, after whatever made es refuse them
+    is fixed. Anything that still fails goes to a fresh dead-letter file. Note
+    these can be older than what's indexed since, so you may want to follow
+    up with import_to_es if a lot piled up.
+    """
+    replay_loc = DEAD_LETTER_LOC + '.replaying'
+    os.rename(DEAD_LETTER_LOC, replay_loc)
+    with open(replay_loc) as f:
+        actions = [json.loads(line)['action'] for line in f if line.strip()]
+
+    es = Elasticsearch(ES_HOSTS, timeout=30)
+    failed_count = 0
+    for i in range(0, len(actions), ES_CHUNK_SIZE):
+        _, _, failed = post_bulk(es, actions[i:i + ES_CHUNK_SIZE])
+        if failed:
+            dead_letter(failed)
+            failed_count += len(failed)
+    os.remove(replay_loc)
+    log.info(f"replayed {len(actions)} actions, {failed_count} failed again")
+
+if sys.argv[2:] == ['replay']:
+    replay_dead_letter()
+    sys.exit(0)
+
+loop = asyncio.get_event_loop()
+es = Elasticsearch(ES_HOSTS, timeout=30, maxsize=ES_CONCURRENCY)
+executor = ThreadPoolExecutor(max_workers=ES_CONCURRENCY)
+checkpoint = Checkpoint()
+stats_filter = StatsFilter(checkpoint, STATS_MIN_ABSOLUTE_CHANGE, STATS_MIN_RELATIVE_CHANGE,
+                           STATS_MIN_INTERVAL, STATS_MAX_TRACKED)
+
+# in-memory queues between binlog and es. The bigger they are, the more events we
 # can parse in memory while waiting for es to catch up, at the expense of heap.
-buf = Queue(maxsize=INTERNAL_QUEUE_DEPTH)
+buf = asyncio.Queue(maxsize=INTERNAL_QUEUE_DEPTH)
+lanes = [asyncio.Queue(maxsize=ES_CHUNK_SIZE) for _ in range(ES_CONCURRENCY)]
+sizer = ChunkSizer(ES_MIN_CHUNK_SIZE, ES_CHUNK_SIZE, ES_TARGET_BULK_TIME)
+posters = [EsPoster(es, executor, lane, checkpoint, sizer, flush_interval=FLUSH_INTERVAL)
+           for lane in lanes]
 
-reader = BinlogReader(buf)
+reader = BinlogReader(buf, loop)
 reader.daemon = True
-writer = EsPoster(buf, chunk_size=ES_CHUNK_SIZE, flush_interval=FLUSH_INTERVAL)
-writer.daemon = True
 reader.start()
-writer.start()
 
-# on the main thread, poll the queue size for monitoring
-while True:
-    stats.gauge('queue_depth', buf.qsize())
-    time.sleep(1)
+pipeline = asyncio.gather(
+    dispatch(buf, lanes, checkpoint, stats_filter),
+    sweep_stats(lanes, stats_filter),
+    monitor(buf, lanes, checkpoint),
+    *(poster.run() for poster in posters))
+
+if REPLAY_LOC:
+    # a replay isn't a position in the real binlog, so don't save it
+    done = asyncio.ensure_future(finish_replay(reader, lanes, checkpoint, stats_filter))
+else:
+    # runs until something fails; the position saved by then is safe to restart from
+    done = asyncio.gather(reader.done, save_position(checkpoint))
+
+finished, _ = loop.run_until_complete(
+    asyncio.wait([pipeline, done], return_when=asyncio.FIRST_COMPLETED))
+for future in finished:
+    future.result()
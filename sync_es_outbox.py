@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Keep elasticsearch in sync from the es_outbox table, for databases where
+sync_es.py can't read a binlog (SQLite, managed MySQL without REPLICATION
+permissions).
+
+With USE_ES_OUTBOX enabled, the app adds an outbox row naming the torrent in
+the same transaction as every upload, edit, delete and stats change it makes.
+This script drains the table in batches: each batch rebuilds the current
+document of every torrent named in it (or deletes the document if the torrent
+is gone) in a single bulk request, then removes the rows it handled. If
+elasticsearch or this script is down, the rows just pile up until it's back.
+
+Anything writing to the torrents or statistics tables outside the app (like a
+tracker scraper) has to add the outbox rows itself, eg.
+    INSERT INTO nyaa_es_outbox (torrent_id, created_time) VALUES (?, NOW())
+
+Since documents are rebuilt from the database instead of from the change
+itself, handling a row twice is harmless, and several changes to one torrent
+in a batch only index it once.
+
+If es rejects some of a batch for a reason that may pass (429, 503 or no
+connection), the whole batch is tried again. Anything else it rejects is
+written to the dead-letter file (ES_OUTBOX_DEAD_LETTER) and its rows are
+removed with the rest, so one bad torrent can't hold up the outbox. Once the
+cause is fixed, add outbox rows for the torrent ids in the file to index them.
+"""
+from nyaa import app, db
+from nyaa import es_docs
+from nyaa.models import Torrent, Statistic, EsOutbox
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk
+import json
+import time
+import logging
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s - %(message)s')
+
+log = logging.getLogger('sync_es_outbox')
+log.setLevel(logging.INFO)
+
+INDEX_NAME = app.config['ES_INDEX_NAME']
+# hidden and deleted torrents go here instead, if set
+HIDDEN_INDEX_NAME = app.config.get('ES_HIDDEN_INDEX_NAME')
+BATCH_SIZE = app.config.get('ES_OUTBOX_BATCH_SIZE', 1000)
+POLL_INTERVAL = app.config.get('ES_OUTBOX_POLL_INTERVAL', 5)
+# bulk items es refuses for good end up here
+DEAD_LETTER_LOC = app.config.get('ES_OUTBOX_DEAD_LETTER', '/tmp/sync_es_outbox_dead_letter.jsonl')
+# bulk item statuses that mean es is busy, rather than the item being bad
+RETRY_STATUSES = {429, 503}
+
+
+# just the columns the documents need, like import_to_es
+DOC_COLUMNS = tuple(getattr(Torrent, field) for field in es_docs.TORRENT_FIELDS) + \
+    tuple(getattr(Statistic, field) for field in es_docs.STATS_FIELDS)
+
+
+def reindex_torrents(rows):
+    actions = []
+    for doc in es_docs.torrent_docs(rows):
+        target, other = INDEX_NAME, HIDDEN_INDEX_NAME
+        if HIDDEN_INDEX_NAME and not es_docs.is_public(doc):
+            target, other = HIDDEN_INDEX_NAME, INDEX_NAME
+        actions.append({
+            '_op_type': 'index',
+            '_index': target,
+            '_type': 'torrent',
+            '_id': str(doc['id']),
+            '_source': doc,
+        })
+        if other:
+            # in case it was in the other index before
+            actions.append(delet_this(doc['id'], other))
+    return actions
+
+
+def delet_this(torrent_id, index_name=INDEX_NAME):
+    return {
+        '_op_type': 'delete',
+        '_index': index_name,
+        '_type': 'torrent',
+        '_id': str(torrent_id)}
+
+
+class RetryBatch(Exception):
+    ''' Raised when es is too busy for some of a batch, which is then tried again whole '''
+    pass
+
+
+def dead_letter(failed):
+    ''' Appends the bulk items es refused to DEAD_LETTER_LOC, one JSON object per line '''
+    log.error(f"writing {len(failed)} failed actions to {DEAD_LETTER_LOC}")
+    with open(DEAD_LETTER_LOC, 'a') as f:
+        for op_type, result in failed:
+            f.write(json.dumps({'op_type': op_type, 'torrent_id': result.get('_id'),
+                                'index': result.get('_index'), 'status': result.get('status'),
+                                'error': result.get('error')}) + '\n')
+
+
+def sync_batch(es):
+    ''' Handles one batch of outbox rows, returns how many there were '''
+    rows = db.session.query(EsOutbox.id, EsOutbox.torrent_id) \
+        .order_by(EsOutbox.id).limit(BATCH_SIZE).all()
+    if not rows:
+        return 0
+
+    torrent_ids = set(torrent_id for _, torrent_id in rows)
+    torrents = db.session.query(*DOC_COLUMNS) \
+        .outerjoin(Statistic, Statistic.torrent_id == Torrent.id) \
+        .filter(Torrent.id.in_(torrent_ids)).all()
+
+    actions = reindex_torrents(torrents)
+    actions += [delet_this(torrent_id, index_name)
+                for torrent_id in torrent_ids - set(t.id for t in torrents)
+                for index_name in (INDEX_NAME, HIDDEN_INDEX_NAME) if index_name]
+
+    # Connection errors still raise, leaving the rows for the next try
+    _, errors = bulk(es, actions, chunk_size=BATCH_SIZE, raise_on_error=False)
+    failed = []
+    for error in errors:
+        (op_type, result), = error.items()
+        if op_type == 'delete' and result.get('status') == 404:
+            # Deleting a torrent that never made it into es is fine
+            continue
+        if result.get('status') in RETRY_STATUSES:
+            raise RetryBatch(f"es is busy ({result.get('status')}), retrying the batch")
+        failed.append((op_type, result))
+    if failed:
+        dead_letter(failed)
+
+    # Delete exactly the rows we read; rows with lower ids may still be
+    # committed by other transactions after we looked.
+    EsOutbox.query.filter(EsOutbox.id.in_([row_id for row_id, _ in rows])) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+    log.info(f"indexed {len(torrents)}, deleted {len(torrent_ids) - len(torrents)} "
+             f"from {len(rows)} outbox rows")
+    return len(rows)
+
+
+def main():
+    es = Elasticsearch(timeout=30)
+
+    while True:
+        try:
+            count = sync_batch(es)
+        except Exception:
+            db.session.rollback()
+            log.exception("failed to sync batch, retrying")
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        if count < BATCH_SIZE:
+            # End the transaction so the next poll sees new rows
+            db.session.rollback()
+            time.sleep(POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    main()
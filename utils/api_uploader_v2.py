@@ -55,7 +55,7 @@ class CategoryPrintAction(argparse.Action):
             print(NYAA_CATS)
         parser.exit()
 
-environment_epillog = '''You may also provide environment variables NYAA_API_HOST, NYAA_API_USERNAME and NYAA_API_PASSWORD for connection info.'''
+environment_epillog = '''You may also provide environment variables NYAA_API_HOST, NYAA_API_USERNAME, NYAA_API_PASSWORD and NYAA_API_TOKEN for connection info.'''
 
 parser = argparse.ArgumentParser(description='Upload torrents to Nyaa.si', epilog=environment_epillog)
 
@@ -67,6 +67,7 @@ conn_group.add_argument('-s', '--sukebei', default=False, action='store_true', h
 
 conn_group.add_argument('-u', '--user', help='Username or email')
 conn_group.add_argument('-p', '--password', help='Password')
+conn_group.add_argument('-t', '--token', help='API token (from your profile), used instead of username and password')
 conn_group.add_argument('--host', help='Select another api host (for debugging purposes)')
 
 resp_group = parser.add_argument_group('Response options')
@@ -133,12 +134,17 @@ if __name__ == "__main__":
 
     api_username = args.user     or os.getenv('NYAA_API_USERNAME')
     api_password = args.password or os.getenv('NYAA_API_PASSWORD')
-    
-    if not (api_username and api_password):
+    api_token    = args.token    or os.getenv('NYAA_API_TOKEN')
+
+    auth = None
+    headers = {}
+    if api_token:
+        headers['Authorization'] = 'Bearer ' + api_token
+    elif api_username and api_password:
+        auth = (api_username, api_password)
+    else:
         raise Exception('No authorization found from arguments or environment variables.')
 
-    auth = (api_username, api_password)
-
     data = {
         'name' : args.name,
         'category' : args.category,
@@ -161,7 +167,7 @@ if __name__ == "__main__":
     }
 
     # Go!
-    r = requests.post(api_upload_url, auth=auth, data=encoded_data, files=files)
+    r = requests.post(api_upload_url, auth=auth, headers=headers, data=encoded_data, files=files)
     torrent_file.close()
 
     if args.raw:
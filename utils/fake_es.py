@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+A stand-in for elasticsearch's bulk endpoint, for benchmarking sync_es.py
+offline (with a recording, see `replay_loc` in sync_es.py). Every action in a
+bulk request is acknowledged without storing anything, after a configurable
+delay, and optionally some are rejected with 429 like an overloaded cluster.
+
+Point sync_es at it with "es_hosts": ["localhost:9201"] in its config.
+"""
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+parser = argparse.ArgumentParser(description='Fake elasticsearch bulk endpoint.')
+parser.add_argument('--host', default='localhost')
+parser.add_argument('--port', type=int, default=9201)
+parser.add_argument('--latency', type=float, default=0.0,
+                    help='seconds to wait before answering each request')
+parser.add_argument('--latency-per-action', type=float, default=0.0,
+                    help='seconds to wait per action in a bulk request, on top of --latency')
+parser.add_argument('--reject-rate', type=float, default=0.0,
+                    help='fraction of actions to reject with 429, between 0 and 1')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeEsHandler(BaseHTTPRequestHandler):
+    args = None
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_GET(self):
+        self.send_json(200, {'name': 'fake_es', 'version': {'number': '5.3.0'}})
+
+    def do_POST(self):
+        if not self.path.split('?')[0].endswith('/_bulk'):
+            self.send_json(404, {'error': 'only _bulk is faked'})
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        lines = self.rfile.read(length).decode('utf-8').splitlines()
+
+        items = []
+        errors = False
+        lines = iter(line for line in lines if line.strip())
+        for line in lines:
+            op_type, meta = json.loads(line).popitem()
+            if op_type != 'delete':
+                # the document, or the partial update
+                next(lines)
+            item = {'_index': meta.get('_index'), '_type': meta.get('_type'),
+                    '_id': meta.get('_id')}
+            if random.random() < self.args.reject_rate:
+                item['status'] = 429
+                errors = True
+                item['error'] = {'type': 'es_rejected_execution_exception',
+                                 'reason': 'rejected by fake_es'}
+            else:
+                item['status'] = 201 if op_type == 'create' else 200
+            items.append({op_type: item})
+
+        took = self.args.latency + self.args.latency_per_action * len(items)
+        time.sleep(took)
+        self.send_json(200, {
+            'took': int(took * 1000),
+            'errors': errors,
+            'items': items,
+        })
+
+    def log_message(self, format, *args):
+        # one line per bulk request would drown out the benchmark
+        pass
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    FakeEsHandler.args = args
+    server = ThreadingHTTPServer((args.host, args.port), FakeEsHandler)
+    print('Fake elasticsearch listening on {}:{}'.format(args.host, args.port))
+    server.serve_forever()